@@ -23,7 +23,7 @@
 
 
 import collections
-from itertools import chain, starmap
+from itertools import chain, starmap, imap
 
 
 quot = '"{}"'.format
@@ -50,6 +50,17 @@ def flatjoin(lst, st):
     return st.join(flatten(lst))
 
 
+def flatwrite(lst, st, out):
+    # same output as flatjoin, but written to out line by line
+    lines = flatten(lst)
+    for line in lines:
+        out.write(line)
+        break
+    for line in lines:
+        out.write(st)
+        out.write(line)
+
+
 def prune_empty(*lst):
     if len(lst) == 1:
         return [el for el in lst[0] if el]
@@ -111,7 +122,7 @@ class BaseGenerator():
 
                 return chain(
                     flatten(self.start),
-                    map(prefix, flatten(self.body)),
+                    imap(prefix, flatten(self.body)),
                     flatten(self.end)
                 )
 
@@ -133,7 +144,7 @@ class BaseGenerator():
                 def prefix(count, lines):
                     def _prefix(line):
                         return self.line_prefix * count + line if len(line) else ''
-                    return map(_prefix, flatten(lines))
+                    return imap(_prefix, flatten(lines))
 
                 return starmap(prefix, self.body)
 
@@ -0,0 +1,268 @@
+# Copyright (c) 2014-2015, Ericsson AB. All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without modification,
+# are permitted provided that the following conditions are met:
+#
+# 1. Redistributions of source code must retain the above copyright notice, this
+# list of conditions and the following disclaimer.
+#
+# 2. Redistributions in binary form must reproduce the above copyright notice, this
+# list of conditions and the following disclaimer in the documentation and/or other
+# materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS" AND
+# ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE DISCLAIMED.
+# IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT,
+# INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT
+# NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR
+# PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY,
+# WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY
+# OF SUCH DAMAGE.
+
+
+
+# Generates synthetic .gir files of increasing size and runs gen_jni.py on each
+# of them, reporting time, memory and output size per size. Every size runs in
+# its own process since the generators keep global state.
+#
+#   python benchmark.py --classes 10 100 1000 --methods 10
+
+import os
+import sys
+import json
+import shutil
+import tempfile
+import argparse
+import subprocess
+from xml.sax.saxutils import quoteattr
+
+
+NAMESPACE = 'Bench'
+PREFIX = 'bench'
+
+METHOD_KINDS = ['int', 'string', 'enum', 'flags', 'list', 'table', 'list_param', 'table_param', 'callback']
+
+
+def tag(name, attrs, body=None):
+    attrs = ''.join(' {}={}'.format(k, quoteattr(str(v))) for k, v in attrs)
+    if body is None:
+        return '<{}{}/>'.format(name, attrs)
+    return '<{}{}>{}</{}>'.format(name, attrs, ''.join(body), name)
+
+
+def typ(name, c_type, *inner):
+    attrs = [('name', name)]
+    if c_type is not None:
+        attrs.append(('c:type', c_type))
+    return tag('type', attrs, list(inner) if inner else None)
+
+
+def param(name, type_tag, transfer='none', kind='parameter', **extra):
+    return tag(kind, [('name', name), ('transfer-ownership', transfer)] + sorted(extra.items()), [type_tag])
+
+
+def retval(type_tag=None, transfer='none'):
+    return tag('return-value', [('transfer-ownership', transfer)], [type_tag or typ('none', 'void')])
+
+
+def enum_tag(kind, name, members, bitfield=False):
+    c_name = NAMESPACE + name
+    return tag(kind, [('name', name), ('c:type', c_name)], [
+        tag('member', [
+            ('name', 'm%d' % i),
+            ('value', 1 << i if bitfield else i),
+            ('c:identifier', '%s_%s_M%d' % (PREFIX.upper(), name.upper(), i)),
+        ]) for i in range(members)
+    ])
+
+
+def method_tag(clazz, index, enums, bitfields):
+    kind = METHOD_KINDS[index % len(METHOD_KINDS)]
+    name = 'method_%s_%d' % (kind, index)
+    c_class = NAMESPACE + clazz
+    params = [param('self', typ(clazz, c_class + '*'), kind='instance-parameter')]
+    ret = retval()
+
+    if kind == 'int':
+        params.append(param('value', typ('gint', 'gint')))
+        ret = retval(typ('gint', 'gint'))
+    elif kind == 'string':
+        params.append(param('value', typ('utf8', 'const gchar*')))
+        ret = retval(typ('utf8', 'gchar*'), transfer='full')
+    elif kind == 'enum' and enums:
+        enum = enums[index % len(enums)]
+        params.append(param('value', typ(enum, NAMESPACE + enum)))
+    elif kind == 'flags' and bitfields:
+        bitfield = bitfields[index % len(bitfields)]
+        ret = retval(typ(bitfield, NAMESPACE + bitfield))
+    elif kind == 'list':
+        ret = retval(typ('GLib.List', 'GList*', typ(clazz, None)), transfer='container')
+    elif kind == 'table':
+        ret = retval(typ('GLib.HashTable', 'GHashTable*', typ('utf8', None), typ('utf8', None)), transfer='full')
+    elif kind == 'list_param':
+        params.append(param('values', typ('GLib.List', 'GList*', typ('utf8', None))))
+    elif kind == 'table_param':
+        params.append(param('values', typ('GLib.HashTable', 'GHashTable*', typ('utf8', None), typ('utf8', None))))
+    elif kind == 'callback':
+        params.append(param('callback', typ('Callback', NAMESPACE + 'Callback'), scope='async', closure='2'))
+        params.append(param('user_data', typ('gpointer', 'gpointer')))
+
+    return tag('method', [('name', name), ('c:identifier', '%s_%s_%s' % (PREFIX, clazz.lower(), name))], [
+        ret, tag('parameters', [], params),
+    ])
+
+
+def class_tag(index, methods, signals, properties, enums, bitfields):
+    name = 'Class%d' % index
+    c_class = NAMESPACE + name
+    symbol = 'class%d' % index
+    body = [tag('constructor', [('name', 'new'), ('c:identifier', '%s_%s_new' % (PREFIX, symbol))], [
+        retval(typ(name, c_class + '*'), transfer='full'),
+    ])]
+    body += [method_tag(name, i, enums, bitfields) for i in range(methods)]
+    body += [tag('property', [('name', 'prop-%d' % i), ('writable', 1), ('transfer-ownership', 'none')], [
+        typ('gint', 'gint') if i % 2 else typ('utf8', 'gchar*'),
+    ]) for i in range(properties)]
+    body += [tag('glib:signal', [('name', 'signal-%d' % i), ('when', 'last')], [
+        retval(),
+        tag('parameters', [], [param('value', typ('gint', 'gint'))]),
+    ]) for i in range(signals)]
+
+    return tag('class', [
+        ('name', name),
+        ('c:symbol-prefix', symbol),
+        ('c:type', c_class),
+        ('parent', 'GObject.Object'),
+        ('glib:type-name', c_class),
+        ('glib:get-type', '%s_%s_get_type' % (PREFIX, symbol)),
+    ], body)
+
+
+def gen_gir(classes, methods, signals, properties, enum_count):
+    enums = ['Enum%d' % i for i in range(enum_count)]
+    bitfields = ['Flags%d' % i for i in range(enum_count)]
+
+    body = [enum_tag('enumeration', name, 4) for name in enums]
+    body += [enum_tag('bitfield', name, 4, bitfield=True) for name in bitfields]
+    body += [tag('callback', [('name', 'Callback'), ('c:type', NAMESPACE + 'Callback')], [
+        retval(),
+        tag('parameters', [], [
+            param('code', typ('gint', 'gint')),
+            param('user_data', typ('gpointer', 'gpointer'), closure='1'),
+        ]),
+    ])]
+    body += [class_tag(i, methods, signals, properties, enums, bitfields) for i in range(classes)]
+
+    namespace = tag('namespace', [
+        ('name', NAMESPACE),
+        ('version', '1.0'),
+        ('shared-library', 'lib%s.so' % PREFIX),
+        ('c:identifier-prefixes', NAMESPACE),
+        ('c:symbol-prefixes', PREFIX),
+    ], body)
+
+    return '<?xml version="1.0"?>\n' + tag('repository', [
+        ('version', '1.2'),
+        ('xmlns', 'http://www.gtk.org/introspection/core/1.0'),
+        ('xmlns:c', 'http://www.gtk.org/introspection/c/1.0'),
+        ('xmlns:glib', 'http://www.gtk.org/introspection/glib/1.0'),
+    ], [namespace])
+
+
+def dir_size(path):
+    files = 0
+    size = 0
+    for root, _, filenames in os.walk(path):
+        for filename in filenames:
+            files += 1
+            size += os.path.getsize(os.path.join(root, filename))
+    return files, size
+
+
+def run(work_dir, classes, args):
+    gir_path = os.path.join(work_dir, '%s-%d.gir' % (NAMESPACE, classes))
+    out_dir = os.path.join(work_dir, 'out-%d' % classes)
+    profile_path = os.path.join(work_dir, 'profile-%d.json' % classes)
+
+    with open(gir_path, 'w') as f:
+        f.write(gen_gir(classes, args.methods, args.signals, args.properties, args.enums))
+
+    command = [sys.executable, os.path.join(os.path.dirname(os.path.abspath(__file__)), 'gen_jni.py'),
+        '--gir', gir_path,
+        '--c-out', os.path.join(out_dir, 'c', 'bench.c'),
+        '--j-out', os.path.join(out_dir, 'java'),
+        '--headers', 'bench.h',
+        '--package-root', 'org.bench',
+        '--log-tag', 'Bench',
+        '--jobs', str(args.jobs),
+        '--profile', profile_path,
+    ] + args.extra
+    with open(os.devnull, 'w') as devnull:
+        subprocess.check_call(command, stdout=devnull)
+
+    with open(profile_path) as f:
+        profile = json.load(f)
+    files, size = dir_size(out_dir)
+
+    return {
+        'classes': classes,
+        'methods': classes * args.methods,
+        'gir_bytes': os.path.getsize(gir_path),
+        'wall_time': profile['wall_time'],
+        'peak_memory_kb': profile['peak_memory_kb'],
+        'output_files': files,
+        'output_bytes': size,
+        'phases': dict((name, phase['wall_time']) for name, phase in profile['phases'].items()),
+    }
+
+
+def print_table(results):
+    columns = [
+        ('classes', '{:>8}'),
+        ('methods', '{:>8}'),
+        ('wall_time', '{:>10.3f}'),
+        ('ms/class', '{:>9.3f}'),
+        ('peak_memory_kb', '{:>15}'),
+        ('output_files', '{:>13}'),
+        ('output_bytes', '{:>13}'),
+    ]
+    print(' '.join(fmt.replace('.3f', '').format(name) for name, fmt in columns))
+    for result in results:
+        result = dict(result, **{'ms/class': 1000.0 * result['wall_time'] / result['classes']})
+        print(' '.join(fmt.format(result[name]) for name, fmt in columns))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark gen_jni.py with synthetic .gir files')
+    parser.add_argument('--classes', nargs='+', type=int, default=[10, 50, 100, 500], metavar='N',
+                        help='number of classes of each generated .gir file')
+    parser.add_argument('--methods', type=int, default=10, metavar='M', help='methods per class')
+    parser.add_argument('--signals', type=int, default=2, help='signals per class')
+    parser.add_argument('--properties', type=int, default=2, help='properties per class')
+    parser.add_argument('--enums', type=int, default=4, help='number of enums and of bitfields')
+    parser.add_argument('--jobs', type=int, default=1, help='passed on to gen_jni.py')
+    parser.add_argument('--json', dest='json_path', metavar='FILE', help='write the results to FILE as JSON')
+    parser.add_argument('--keep', metavar='DIR', help='keep the generated .gir files and output in DIR')
+    parser.add_argument('extra', nargs='*', help='extra arguments for gen_jni.py, after --')
+    args = parser.parse_args()
+
+    work_dir = args.keep or tempfile.mkdtemp(prefix='gen_jni_bench_')
+    if not os.path.isdir(work_dir):
+        os.makedirs(work_dir)
+
+    try:
+        results = [run(work_dir, classes, args) for classes in args.classes]
+    finally:
+        if not args.keep:
+            shutil.rmtree(work_dir)
+
+    print_table(results)
+    if args.json_path:
+        with open(args.json_path, 'w') as f:
+            json.dump(results, f, indent=4)
+
+
+if __name__ == '__main__':
+    main()
@@ -22,7 +22,14 @@
 # OF SUCH DAMAGE.
 
 
+import os
+import re
+import copy
+import shutil
 import config
+import tempfile
+import collections
+from StringIO import StringIO
 from functools import partial
 from collections import defaultdict
 from itertools import imap
@@ -112,6 +119,19 @@ class ExceptionCheck(C.Lines):
         return cls(value.parent.return_value.default_value)
 
 
+# Leaves the exception pending for the caller, which reports it through its own ExceptionCheck
+@add_to(C)
+class ExceptionPending(C.Lines):
+    def __init__(self, value):
+        self.value = value
+
+    def __iter__(self):
+        yield C.If(C.Env('ExceptionCheck'),
+            C.Log('warning', 'exception at %s:%d', '__FILE__', '__LINE__'),
+            C.Return(self.value),
+        )
+
+
 @add_to(C)
 class CommentHeader(C.Comment):
     def __iter__(self):
@@ -139,6 +159,10 @@ class Function(C.FunctionBlock):
     def start(self):
         return [self.definition, '{']
 
+    @property
+    def prototype(self):
+        return semi(self.definition)
+
     @staticmethod
     def callback(callback, body=None, **kwargs):
         args = {
@@ -164,6 +188,7 @@ class JniExport(C.FunctionBlock):
             method_name=None,
             return_type='void',
             params=None,
+            signature=None,
             **kwargs):
         super(JniExport, self).__init__(**kwargs)
         self.package = package
@@ -172,6 +197,14 @@ class JniExport(C.FunctionBlock):
         self.method_name = method_name
         self.return_type = return_type
         self.java_params = params or []
+        self.signature = signature
+        # registered through a method table instead of being looked up by name
+        if config.REGISTER_NATIVES:
+            self.modifiers = ['static']
+
+    @property
+    def java_class_path(self):
+        return '/'.join(self.package.split('.') + [self.clazz]) + ('$' + self.subclass if self.subclass else '')
 
     @property
     def name(self):
@@ -201,6 +234,7 @@ class JniExport(C.FunctionBlock):
             'return_type': function.params.return_value.jni_type,
             'method_name': function.name,
             'params': params,
+            'signature': function.method_signature,
             'body': [C.TypeConversions.params_to_c(function.params, body=body, get_env=False)],
         }
         if function.params.return_value.name is not None:
@@ -209,6 +243,48 @@ class JniExport(C.FunctionBlock):
         return JniExport(**args)
 
 
+def find_exports(body):
+    for line in body:
+        if isinstance(line, JniExport):
+            yield line
+        elif isinstance(line, (list, tuple)):
+            for export in find_exports(line):
+                yield export
+
+
+@add_to(C)
+class NativeMethodTable(C.Lines):
+    def __init__(self, class_path, exports, storage='static'):
+        self.class_path = class_path
+        # only the entries are kept, so that the units can be dropped once written
+        self.entries = [(export.method_name, export.signature, export.name) for export in exports]
+        self.storage = storage
+
+    @property
+    def name(self):
+        return 'natives_' + re.sub(r'\W', '_', self.class_path)
+
+    @property
+    def declaration(self):
+        return C.Decl('extern JNINativeMethod', '%s[%d]' % (self.name, len(self.entries)))
+
+    def __iter__(self):
+        yield C.Block(
+            _start=' '.join(prune_empty(self.storage, 'JNINativeMethod', self.name + '[] = {')),
+            body=['{%s, %s, (void*) %s},' % (quot(method_name), quot(signature), name)
+                for method_name, signature, name in self.entries],
+            _end='};',
+        )
+
+    @classmethod
+    def from_body(cls, body, storage='static'):
+        # one table for each class that has exports in the body
+        tables = collections.OrderedDict()
+        for export in find_exports(body):
+            tables.setdefault(export.java_class_path, []).append(export)
+        return [cls(class_path, exports, storage) for class_path, exports in tables.items()]
+
+
 @add_to(C)
 class Helper(C.Call):
     helper_functions = {}
@@ -237,7 +313,10 @@ class Cache(C.Lines):
         self.args = list(args)
 
     def __iter__(self):
-        yield 'cache_' + flatjoin(self.args, '_')
+        if config.LAZY_CACHE:
+            yield 'get_cache_' + flatjoin(self.args, '_') + '()'
+        else:
+            yield 'cache_' + flatjoin(self.args, '_')
 
     @classmethod
     def clazz(cls, *args):
@@ -284,7 +363,8 @@ class Cache(C.Lines):
         return cls(enum.name, member.name)
 
     @classmethod
-    def enumerate_cached_classes(cls):
+    def enumerate_cached_classes(cls, storage='static'):
+        declare = lambda var_type, name: C.Decl(' '.join(prune_empty(storage, var_type)), name)
         cache_declarations = []
         jni_onload_cache = []
 
@@ -293,7 +373,7 @@ class Cache(C.Lines):
             to_cache_var = lambda *args: '_'.join(['cache'] + classname.split('$') + list(args))
 
             classvar = to_cache_var()
-            cache_declarations += [C.Decl('static jclass', classvar)]
+            cache_declarations += [declare('jclass', classvar)]
             jni_onload_cache += [
                 C.Assign(classvar, C.Env('FindClass', quot(classpath))),
                 C.ExceptionCheck('0'),
@@ -307,7 +387,7 @@ class Cache(C.Lines):
                     methodvar = to_cache_var(methodname)
                     if methodname == '_constructor':
                         methodname = '<init>'
-                    cache_declarations += [C.Decl('static ' + var_type, methodvar)]
+                    cache_declarations += [declare(var_type, methodvar)]
                     jni_onload_cache += [
                         C.Log('debug', 'getting %s.%s', quot(classname), quot(methodname)),
                         C.Assign(methodvar, C.Env(getfunc, classvar, quot(methodname), quot(signature))),
@@ -317,6 +397,77 @@ class Cache(C.Lines):
             jni_onload_cache.append('')
         return cache_declarations[:-1], jni_onload_cache[:-1]
 
+    @classmethod
+    def enumerate_lazy_cached_classes(cls):
+        # Every cached value gets an accessor that resolves it on first use. Classes
+        # are loaded through the class loader of the library, so that they are found
+        # from native threads as well.
+        cache_declarations = []
+        cache_accessors = []
+
+        for classpath, clazz in Cache.cached_classes.items():
+            classname = classpath[classpath.rfind('/')+1:]
+            to_cache_var = lambda *args: '_'.join(['cache'] + classname.split('$') + list(args))
+
+            classvar = to_cache_var()
+            cache_declarations += [C.Decl('static jclass', classvar)]
+            cache_accessors += [C.Function('get_' + classvar,
+                return_type='jclass',
+                params=['void'],
+                body=[
+                    C.Decl('JNIEnv*', 'env'),
+                    C.Decl('jclass', 'clazz'),
+                    C.Decl('jclass', 'local'),
+                    '',
+                    C.Assign('clazz', C.Call('g_atomic_pointer_get', '&' + classvar), cast='jclass'),
+                    C.If(C.Call('G_LIKELY', 'clazz'), C.Return('clazz')),
+                    '',
+                    C.Assign('env', C.Call('get_jni_env')),
+                    C.Log('debug', 'loading %s', quot(classpath)),
+                    C.Assign('local', C.Call('load_class', 'env', quot(classpath.replace('/', '.')))),
+                    C.If('!local', C.Return('NULL')),
+                    C.Assign('clazz', C.Env('NewGlobalRef', 'local')),
+                    C.Env('DeleteLocalRef', 'local'),
+                    C.If('!g_atomic_pointer_compare_and_exchange(&%s, NULL, clazz)' % classvar, [
+                        C.Env('DeleteGlobalRef', 'clazz'),
+                        C.Assign('clazz', C.Call('g_atomic_pointer_get', '&' + classvar), cast='jclass'),
+                    ]),
+                    C.Return('clazz'),
+                ]
+            )]
+
+            for getfunc, method in clazz.items():
+                var_type = 'jmethodID' if 'Method' in getfunc else 'jfieldID'
+                for methodname, signature in method.items():
+                    methodvar = to_cache_var(methodname)
+                    if methodname == '_constructor':
+                        methodname = '<init>'
+                    cache_declarations += [C.Decl('static ' + var_type, methodvar)]
+                    cache_accessors += [C.Function('get_' + methodvar,
+                        return_type=var_type,
+                        params=['void'],
+                        body=[
+                            C.Decl('JNIEnv*', 'env'),
+                            C.Decl('jclass', 'clazz'),
+                            C.Decl(var_type, 'id'),
+                            '',
+                            C.Assign('id', C.Call('g_atomic_pointer_get', '&' + methodvar), cast=var_type),
+                            C.If(C.Call('G_LIKELY', 'id'), C.Return('id')),
+                            '',
+                            C.Assign('env', C.Call('get_jni_env')),
+                            C.Assign('clazz', C.Call('get_' + classvar)),
+                            C.If('!clazz', C.Return('NULL')),
+                            C.Log('debug', 'getting %s.%s', quot(classname), quot(methodname)),
+                            C.Assign('id', C.Env(getfunc, 'clazz', quot(methodname), quot(signature))),
+                            C.ExceptionPending('NULL'),
+                            # ids never change, racing threads store the same value
+                            C.Call('g_atomic_pointer_set', '&' + methodvar, 'id'),
+                            C.Return('id'),
+                        ]
+                    )]
+            cache_declarations.append('')
+        return cache_declarations[:-1], intersperse(cache_accessors, '')
+
 
 @add_to(C)
 class Env(C.Lines):
@@ -377,11 +528,39 @@ class Env(C.Lines):
             *map(jni_arg, callback.params.java_params)
         )
 
+    def replace_lazy_caches(self):
+        # replaces the lazily cached arguments with locals, each accessor is called once
+        caches = collections.OrderedDict()
+        def replace(args):
+            replaced = []
+            for arg in args:
+                if isinstance(arg, C.Cache):
+                    accessor = flatjoin(arg, '')
+                    arg = caches.setdefault(accessor, 'lazy%d' % len(caches))
+                elif isinstance(arg, (list, tuple)):
+                    arg = replace(arg)
+                replaced.append(arg)
+            return replaced
+        return replace(self.args), caches
+
     def __iter__(self):
-        yield semi('(*env)->{name}({args})'.format(
+        args, caches = (self.args, None)
+        if config.LAZY_CACHE:
+            args, caches = self.replace_lazy_caches()
+        call = '(*env)->{name}({args})'.format(
             name=self.name,
-            args=flatjoin(['env'] + list(flatten(self.args)), ', '),
-        ))
+            args=flatjoin(['env'] + list(flatten(args)), ', '),
+        )
+        if caches:
+            # a failed lookup returns NULL with the exception pending, the call is then skipped
+            # and the exception is reported by the ExceptionCheck that follows it
+            locals = ' '.join('gpointer %s = %s;' % (local, accessor) for accessor, local in caches.items())
+            found = ' && '.join(caches.values())
+            if self.name in ['CallVoidMethod', 'CallStaticVoidMethod'] or self.name.startswith('Set'):
+                call = '({{ {} if ({}) {}; }})'.format(locals, found, call)
+            else:
+                call = '({{ {} {} ? {} : 0; }})'.format(locals, found, call)
+        yield semi(call)
 
 
 @add_to(C)
@@ -428,6 +607,13 @@ class TypeConversions(C.Lines):
 
 
 
+def function_variants(functions):
+    return sum((function.variants() for function in functions), [])
+
+def native_functions(functions):
+    # functions with bitfields are exported as their variant that passes them as int masks
+    return [function.bitfield_mask_variant() or function for function in functions]
+
 def make_function_gen(package, classname):
     def gen(function):
         call = C.Call(function.c_name, map(c_arg, function.params))
@@ -475,12 +661,16 @@ def gen_class(package, clazz):
     body = [C.CommentHeader(clazz.name)]
     gen_signal_accessors = make_signal_accessors_gen(package, clazz.name)
 
-    for attr in ['constructors', 'functions', 'methods']:
+    body += [C.Comment('constructors') if clazz.constructors else None]
+    body += map(make_function_gen(package, clazz.name), clazz.constructors)
+    for attr in ['functions', 'methods']:
         body += [C.Comment(attr) if getattr(clazz, attr) else None]
-        body += map(make_function_gen(package, clazz.name), getattr(clazz, attr))
+        body += map(make_function_gen(package, clazz.name), native_functions(getattr(clazz, attr)))
+
+    body += map(make_function_gen(package, clazz.name), function_variants(clazz.functions + clazz.methods))
 
     for interface in clazz.interfaces:
-        body += map(make_function_gen(package, clazz.name), interface.methods)
+        body += map(make_function_gen(package, clazz.name), native_functions(interface.methods))
 
     body += [C.Comment('signals') if clazz.signals else None]
     body += map(make_callback_gen(package, clazz.name), clazz.signals)
@@ -538,147 +728,520 @@ def gen_class(package, clazz):
     return intersperse(prune_empty(body), '')
 
 
-def gen_namespace(namespace, package):
-    body = []
+def namespace_unit_names(namespace):
+    return [namespace.symbol_prefix] + [namespace.symbol_prefix + '_' + clazz.c_symbol_prefix
+        for clazz in namespace.classes]
+
+
+def gen_namespace_units(namespace, package):
+    # the units are generated as they are consumed, see namespace_unit_names
     package = package + '.' + namespace.symbol_prefix
 
-    body += map(make_callback_gen(package, namespace.identifier_prefix), namespace.callbacks)
-    body += map(make_function_gen(package, namespace.identifier_prefix), namespace.functions)
-    body += map(partial(gen_class, package), namespace.classes)
+    yield (namespace.symbol_prefix,
+        map(make_callback_gen(package, namespace.identifier_prefix), namespace.callbacks) +
+        map(make_function_gen(package, namespace.identifier_prefix), native_functions(namespace.functions)) +
+        map(make_function_gen(package, namespace.identifier_prefix), function_variants(namespace.functions))
+    )
+    for clazz in namespace.classes:
+        yield (namespace.symbol_prefix + '_' + clazz.c_symbol_prefix, gen_class(package, clazz))
+
+
+def gen_namespace(namespace, package):
+    return sum((body for _, body in gen_namespace_units(namespace, package)), [])
+
 
-    return body
+def enum_member_slots(enum):
+    # maps each distinct value of the enum to a slot in its table of java constants,
+    # indexed directly by value when the values are dense
+    members = []
+    for member in enum.members:
+        if int(member.value) not in [int(m.value) for m in members]:
+            members.append(member)
+    values = [int(member.value) for member in members]
+    low, high = min(values), max(values)
+    if high - low < 2 * len(values):
+        return high - low + 1, [(value - low, member) for value, member in zip(values, members)], low
+    return len(members), list(enumerate(members)), None
 
 
 def add_helpers(namespace):
     for enum in namespace.enums:
+        if not enum.members:
+            continue
+        size, slots, offset = enum_member_slots(enum)
+        if offset is not None:
+            lookup = C.Assign('index', '(gint) value' + (offset and ' - (%d)' % offset or ''))
+        else:
+            lookup = C.Switch('value',
+                cases=[(member.c_name, C.Assign('index', str(slot))) for slot, member in slots],
+                default=[C.Assign('index', '-1')],
+            )
         C.Helper.add_helper(enum.name + '_to_java_enum',
             C.Function(enum.name + '_to_java_enum',
                 return_type='jobject',
                 params=['JNIEnv* env', enum.type.c_type + ' value'],
                 body=[
-                    C.Decl('jfieldID', 'fieldId'),
+                    C.Decl('static jobject', 'members[%d]' % size),
                     C.Decl('jobject', 'result'),
+                    C.Decl('jobject', 'member'),
+                    C.Decl('gint', 'index'),
                     '',
-                    C.Switch('value', cases=[
-                        (member.c_name, C.Assign('fieldId', C.Cache.default_enum_member(enum, member)))
-                        for member in enum.members
+                    lookup,
+                    C.If('index < 0 || index >= %d' % size, [
+                        C.Env.throw('IllegalArgumentException', quot('invalid %s value' % enum.name)),
+                        C.Return('NULL'),
                     ]),
                     '',
-                    C.Assert('fieldId'),
-                    C.Assign('result', Env('GetStaticObjectField', C.Cache(enum.name), 'fieldId')),
-                    C.ExceptionCheck('NULL'),
+                    # the constants are resolved into global refs on first use, conversions are then a table load
+                    C.Assign('result', C.Call('g_atomic_pointer_get', '&members[index]'), cast='jobject'),
+                    C.If(C.Call('G_LIKELY', 'result'), C.Return('result')),
+                    '',
+                    # a failed lookup leaves its slot empty, so that the next conversion retries it
+                    sum([[C.If('!g_atomic_pointer_get(&members[%d])' % slot, [
+                        C.Assign('member', Env('GetStaticObjectField', C.Cache(enum.name), C.Cache.default_enum_member(enum, member))),
+                        C.ExceptionCheck('NULL'),
+                        C.Assign('result', Env('NewGlobalRef', 'member')),
+                        Env('DeleteLocalRef', 'member'),
+                        C.If('!g_atomic_pointer_compare_and_exchange(&members[%d], NULL, result)' % slot,
+                            Env('DeleteGlobalRef', 'result')),
+                    ])] for slot, member in slots], []),
+                    '',
+                    C.Assign('result', C.Call('g_atomic_pointer_get', '&members[index]'), cast='jobject'),
+                    C.If('!result', C.Env.throw('IllegalArgumentException', quot('invalid %s value' % enum.name))),
                     C.Return('result'),
                 ]
             )
         )
 
 
-def gen_source(namespaces, include_headers):
-    body = []
-    package = config.PACKAGE_ROOT
-
-    for namespace in namespaces:
-        add_helpers(namespace)
-
-    for namespace in namespaces:
-        body += gen_namespace(namespace, package)
+Program = collections.namedtuple('Program', [
+    'helper_functions',
+    'native_destructor',
+    'native_containers',
+    'cache_declarations',
+    'cache_accessors',
+    'jni_onload',
+    'java_class_lookup',
+    'native_tables',
+    'native_registration',
+])
+
+
+def gen_native_containers(package):
+    # the native methods of NativeContainer, which NativeList and NativeMap read their items through
+    return intersperse([
+        C.JniExport(
+            package=package,
+            clazz='NativeContainer',
+            method_name='nativeLength',
+            return_type='jint',
+            params=['jclass clazz', 'jlong pointer'],
+            signature='(J)I',
+            body=[
+                '(void) clazz;',
+                '',
+                C.Return('((NativeContainer*) pointer)->length'),
+            ]
+        ),
+        C.JniExport(
+            package=package,
+            clazz='NativeContainer',
+            method_name='nativeGet',
+            return_type='jobject',
+            params=['jclass clazz', 'jlong pointer', 'jint index'],
+            signature='(JI)Ljava/lang/Object;',
+            body=[
+                C.Decl('NativeContainer*', 'container'),
+                C.Decl('NativeContainerItemToJava', 'item_to_java'),
+                '(void) clazz;',
+                '',
+                C.Assign('container', 'pointer', cast='NativeContainer*'),
+                # the items of a map alternate between keys and values
+                C.Assign('item_to_java', 'container->key_to_java && index % 2 == 0 ? container->key_to_java : container->value_to_java'),
+                C.Return(C.Call('item_to_java', 'env', 'container->items[index]')),
+            ]
+        ),
+        C.JniExport(
+            package=package,
+            clazz='NativeContainer',
+            method_name='nativeFree',
+            return_type='void',
+            params=['jclass clazz', 'jlong pointer'],
+            signature='(J)V',
+            body=[
+                '(void) clazz;',
+                '',
+                C.Helper('native_container_free', '(NativeContainer*) pointer'),
+            ]
+        ),
+    ], '')
 
-    jobject_wrapper_struct = C.Block(
-        _start = 'typedef union {',
-        body = [
-            C.Decl('jobject', 'obj'),
-            C.Decl('jweak', 'weak'),
-        ],
-        _end = '} JObjectWrapper;',
-    )
 
-    jobject_callback_wrapper_struct = C.Block(
-        _start = 'typedef struct {',
-        body = [
-            C.Decl('JObjectWrapper', '*wrapper'),
-            C.Decl('gboolean', 'should_destroy'),
-        ],
-        _end = '} JObjectCallbackWrapper;',
-    )
-
-    native_destructor = [C.JniExport(
+def gen_native_registration(package, tables, runtime):
+    # With --register-natives=class the classes register their own tables when
+    # they are initialized, only the methods of the runtime classes are registered up front
+    register_class = C.JniExport(
         package=package,
         clazz='NativeInstance',
-        method_name='nativeDestructor',
+        method_name='nativeRegisterNatives',
         return_type='void',
-        params=['jclass clazz', 'jlong instance_pointer'],
+        params=['jclass clazz', 'jclass target', 'jstring j_class_name'],
+        signature='(Ljava/lang/Class;Ljava/lang/String;)V',
         body=[
-            C.Decl('GWeakRef*', 'ref'),
-            C.Decl('GObject*', 'gobj'),
-            C.Decl('JObjectWrapper*', 'wrapper'),
+            C.Decl('const char*', 'class_name'),
+            C.Decl('JNINativeMethod*', 'methods'),
+            C.Decl('jint', 'count'),
             '(void) clazz;',
             '',
-            C.Assign('ref', 'instance_pointer', cast='GWeakRef*'),
-            C.Assign('gobj', C.Call('g_weak_ref_get', 'ref')),
-            C.Call('g_weak_ref_clear', 'ref'),
-            C.Call('g_free', 'ref'),
+            C.Assign('class_name', C.Env('GetStringUTFChars', 'j_class_name', 'NULL')),
+            C.If('!class_name', C.Return()),
+            C.Assign('methods', 'NULL'),
+            C.Assign('count', '0'),
+            tables and C.IfElse(
+                ifs=['g_str_equal(class_name, %s)' % quot(table.class_path) for table in tables],
+                bodies=[[
+                    C.Assign('methods', table.name),
+                    C.Assign('count', 'G_N_ELEMENTS(%s)' % table.name),
+                ] for table in tables],
+            ),
+            C.If('!methods', C.Log.warning('no native methods for %s', 'class_name')),
+            C.Env('ReleaseStringUTFChars', 'j_class_name', 'class_name'),
+            C.If('methods', C.Env('RegisterNatives', 'target', 'methods', 'count')),
+        ]
+    )
+
+    if config.REGISTER_NATIVES == 'class':
+        runtime_tables = NativeMethodTable.from_body(runtime + [register_class])
+        registered = runtime_tables
+        registration = [register_class] + runtime_tables
+    else:
+        runtime_tables = NativeMethodTable.from_body(runtime)
+        registered = runtime_tables + tables
+        registration = runtime_tables
+
+    register = Function('register_native_methods',
+        return_type='gboolean',
+        params=['JNIEnv* env'],
+        body=[
+            C.Decl('jclass', 'clazz'),
             '',
-            C.If('!gobj',
-                C.Env.throw('IllegalStateException', '"GObject ref was NULL at finalization"'),
-                C.Return()),
-            C.Log('debug', 'unrefing GObject[%p]', 'gobj'),
-            C.Assign('wrapper', C.Call('g_object_get_data', 'gobj', '"java_instance"'), cast='JObjectWrapper*'),
-            C.If('wrapper', [
-                C.Call('g_object_set_data', 'gobj', '"java_instance"', 'NULL'),
-                C.Helper('jobject_wrapper_destroy', 'wrapper', 'TRUE'),
-            ]),
-            C.Call('g_object_unref', 'gobj'),
-        ]),
-    ]
+            [[
+                C.Assign('clazz', C.Env('FindClass', quot(table.class_path))),
+                C.ExceptionCheck('FALSE'),
+                C.Env('RegisterNatives', 'clazz', table.name, 'G_N_ELEMENTS(%s)' % table.name),
+                C.Env('DeleteLocalRef', 'clazz'),
+                C.ExceptionCheck('FALSE'),
+            ] for table in registered],
+            C.Return('TRUE'),
+        ]
+    )
+
+    return intersperse(registration + [register], '')
+
+
+def gen_units(namespaces, native_tables, storage='static'):
+    # The units are generated one at a time, so that each of them can be written and
+    # dropped before the next one. Their native tables are collected in native_tables.
+    package = config.PACKAGE_ROOT
+
+    for namespace in namespaces:
+        add_helpers(namespace)
+
+    for namespace in namespaces:
+        for name, unit in gen_namespace_units(namespace, package):
+            if config.REGISTER_NATIVES:
+                tables = C.NativeMethodTable.from_body(unit, storage)
+                unit = unit + sum([['', table] for table in tables], [])
+                native_tables += tables
+            yield name, unit
+
+
+def gen_program(namespaces, native_tables, storage='static'):
+    # Everything around the units, which depends on the caches and helpers that the
+    # units use, so it can only be generated once all units have been
+    package = config.PACKAGE_ROOT
+
+    native_destructor = intersperse([
+        # shared by the destructors of single instances and of batches from the cleaner
+        C.Function('native_instance_destroy',
+            return_type='gboolean',
+            params=['JNIEnv* env', 'jlong instance_pointer'],
+            body=[
+                C.Decl('GWeakRef*', 'ref'),
+                C.Decl('GObject*', 'gobj'),
+                C.Decl('JObjectWrapper*', 'wrapper'),
+                '',
+                C.If('!instance_pointer', C.Return('TRUE')),
+                C.Assign('ref', 'instance_pointer', cast='GWeakRef*'),
+                C.Assign('gobj', C.Call('g_weak_ref_get', 'ref')),
+                C.Call('g_weak_ref_clear', 'ref'),
+                C.Call('g_free', 'ref'),
+                '',
+                C.If('!gobj', C.Return('FALSE')),
+                C.Log('debug', 'unrefing GObject[%p]', 'gobj'),
+                C.Assign('wrapper', C.Call('g_object_steal_qdata', 'gobj', 'java_instance_quark'), cast='JObjectWrapper*'),
+                C.If('wrapper', C.Helper('jobject_wrapper_destroy', 'env', 'wrapper', 'TRUE')),
+                C.Call('g_object_unref', 'gobj'),
+                C.Return('TRUE'),
+            ]
+        ),
+        C.JniExport(
+            package=package,
+            clazz='NativeInstance',
+            method_name='nativeDestructor',
+            return_type='void',
+            params=['jclass clazz', 'jlong instance_pointer'],
+            signature='(J)V',
+            body=[
+                '(void) clazz;',
+                '',
+                C.If('!native_instance_destroy(env, instance_pointer)',
+                    C.Env.throw('IllegalStateException', '"GObject ref was NULL at finalization"')),
+            ]
+        ),
+        C.JniExport(
+            package=package,
+            clazz='NativeInstance',
+            method_name='nativeDestructorBatch',
+            return_type='void',
+            params=['jclass clazz', 'jlongArray instance_pointers', 'jint count'],
+            signature='([JI)V',
+            body=[
+                C.Decl('jlong*', 'pointers'),
+                C.Decl('jint', 'i'),
+                '(void) clazz;',
+                '',
+                C.Assign('pointers', C.Env('GetLongArrayElements', 'instance_pointers', 'NULL')),
+                C.If('!pointers', C.Return()),
+                '',
+                C.Block(
+                    _start='for (i = 0; i < count; i++) {',
+                    body=[
+                        C.If('!native_instance_destroy(env, pointers[i])',
+                            C.Log.warning('GObject ref was NULL at finalization')),
+                    ],
+                ),
+                '',
+                C.Env('ReleaseLongArrayElements', 'instance_pointers', 'pointers', 'JNI_ABORT'),
+            ]
+        ),
+    ], '')
+
+    native_containers = gen_native_containers(package) if config.LAZY_CONTAINER_FUNCTIONS else []
 
     helper_functions = Helper.enumerate_used_helpers()
 
-    gobject_class_cache = [
-        C.Call('g_hash_table_insert', 'gobject_to_java_class_map', C.Call(clazz.glib_get_type), Cache.default_class(clazz.value))
-    for clazz in namespace.classes for namespace in namespaces];
+    # Resolves the bound class of a GType name, only used on the first lookup of
+    # each GType by java_class_for_type, which caches the result in the GType
+    java_class_lookup = Function('java_class_from_type_name',
+        return_type='jclass',
+        params=['const gchar* type_name'],
+        body=[
+            [C.If(C.Call('g_str_equal', 'type_name', quot(clazz.glib_type_name)), C.Return(Cache.default_class(clazz.value)))
+                for namespace in namespaces for clazz in namespace.classes if clazz.glib_type_name],
+            C.Return('NULL'),
+        ]
+    )
 
     # cached classes need to be enumerated last
-    cache_declarations, jni_onload_cache = C.Cache.enumerate_cached_classes()
+    if config.LAZY_CACHE:
+        cache_declarations, cache_accessors = C.Cache.enumerate_lazy_cached_classes()
+        jni_onload_cache = C.If('!cache_class_loader(env)', C.Return('0'))
+    else:
+        cache_declarations, jni_onload_cache = C.Cache.enumerate_cached_classes(storage)
+        cache_accessors = []
+
+    if config.REGISTER_NATIVES:
+        native_registration = gen_native_registration(package, native_tables, native_destructor + native_containers)
+        register_natives = [C.If('!register_native_methods(env)', C.Return('0')), '']
+    else:
+        native_registration = []
+        register_natives = []
 
     jni_onload = Function(
         name='JNI_OnLoad',
         return_type='jint',
         params=['JavaVM* vm', 'void* reserved'],
-        modifiers=[],
+        # the only symbol that has to be exported when the natives are registered
+        modifiers=['JNIEXPORT'] if config.REGISTER_NATIVES else [],
         body=[
             C.Decl('JNIEnv*', 'env'),
             '',
             C.Assign('jvm', 'vm'),
             C.Assign('env', C.Call('get_jni_env')),
+            # qdata is process global, the package root keeps the libraries of different packages apart
+            C.Assign('java_instance_quark', C.Call('g_quark_from_static_string', quot(config.PACKAGE_ROOT + '.java_instance'))),
+            C.Assign('java_class_quark', C.Call('g_quark_from_static_string', quot(config.PACKAGE_ROOT + '.java_class'))),
             '',
             jni_onload_cache,
             '',
-            C.Assign('gobject_to_java_class_map', C.Call('g_hash_table_new', 'g_direct_hash', 'g_direct_equal')),
-            '',
-            gobject_class_cache,
-            '',
+        ] + register_natives + [
             C.Return('JNI_VERSION_1_6'),
         ]
     )
+    if config.REGISTER_NATIVES:
+        # the registration is emitted after the units that define the tables
+        jni_onload = [native_registration[-1].prototype, '', jni_onload]
+
+    return Program(
+        helper_functions=helper_functions,
+        native_destructor=native_destructor,
+        native_containers=native_containers,
+        cache_declarations=cache_declarations,
+        cache_accessors=cache_accessors,
+        jni_onload=jni_onload,
+        java_class_lookup=java_class_lookup,
+        native_tables=native_tables,
+        native_registration=native_registration,
+    )
+
+
+# Globals of the runtime that are shared by every unit
+RUNTIME_GLOBALS = [
+    ('GQuark', 'java_instance_quark'),
+    ('GQuark', 'java_class_quark'),
+]
+
+def runtime_globals(storage):
+    return [C.Decl(' '.join(prune_empty(storage, var_type)), name) for var_type, name in RUNTIME_GLOBALS]
+
 
+def gen_includes(include_headers):
     include_headers = ['jni.h', 'android/log.h'] + include_headers
-    includes = '\n'.join('#include <' + h + '>' for h in include_headers)
+    return '\n'.join('#include <' + h + '>' for h in include_headers)
+
+
+# Writes a body in parts, with the same output as write_body for the whole body
+class BodyWriter(object):
+    def __init__(self, out, continued=False):
+        self.out = out
+        self.started = continued
+
+    def write(self, body):
+        for item in prune_empty(body):
+            lines = flatten(['', item] if self.started else [item])
+            for line in lines:
+                if self.started:
+                    self.out.write('\n')
+                self.out.write(line)
+                self.started = True
+
+
+def write_body(body, out):
+    BodyWriter(out).write(body)
+
+
+def external(func):
+    func = copy.copy(func)
+    func.modifiers = []
+    return func
+
+
+# The declarations shared between the units of a sharded build are hidden from
+# outside the library, only the JNI entry points are exported
+def internal(prototype):
+    return 'G_GNUC_INTERNAL ' + prototype
 
-    body = [
-        includes,
+
+def write_source(namespaces, include_headers, out):
+    # The units are written to a temporary file as they are generated, and copied to
+    # the output after the declarations and helpers, which are only known at the end
+    native_tables = []
+    spool = tempfile.TemporaryFile()
+    units = BodyWriter(spool, continued=True)
+    for _, unit in gen_units(namespaces, native_tables):
+        units.write(unit)
+    program = gen_program(namespaces, native_tables)
+
+    write_body([
+        gen_includes(include_headers),
         HEADER,
-        cache_declarations,
-        C.Decl('static GHashTable*', 'gobject_to_java_class_map'),
+        program.cache_declarations,
+        runtime_globals('static'),
         GET_JNI_ENV,
-        jni_onload,
-        jobject_wrapper_struct,
-        jobject_callback_wrapper_struct,
-    ] + helper_functions + [native_destructor] + body
+        config.LAZY_CACHE and CLASS_LOADER,
+        program.cache_accessors,
+        program.jni_onload,
+        JOBJECT_WRAPPER_STRUCTS,
+        config.LAZY_CONTAINER_FUNCTIONS and NATIVE_CONTAINER_STRUCTS,
+        program.java_class_lookup,
+    ] + program.helper_functions + [program.native_destructor, program.native_containers], out)
+
+    spool.seek(0)
+    shutil.copyfileobj(spool, out)
+    spool.close()
+
+    BodyWriter(out, continued=True).write([program.native_registration])
 
-    body = intersperse(prune_empty(body), '')
 
-    return flatjoin(body, '\n')
+def gen_source(namespaces, include_headers):
+    out = StringIO()
+    write_source(namespaces, include_headers, out)
+    return out.getvalue()
+
+
+def gen_sharded_source(namespaces, include_headers, header_name, source_name):
+    # Splits the output into a shared header, a runtime unit with JNI_OnLoad and
+    # the helpers, and one unit per namespace and class, so that they can be
+    # compiled in parallel. Everything shared between units gets external linkage.
+    # The units are yielded as they are generated, the header and the runtime unit
+    # come last, when everything that the units use is known.
+    include = '#include "' + header_name + '"'
+
+    # namespace callbacks are referenced from the class units
+    namespace_units = set(namespace.symbol_prefix for namespace in namespaces)
+    unit_filename = lambda name: name + ('_functions.c' if name in namespace_units else '.c')
+
+    # namespace units get a suffix so that they can't replace the runtime unit, e.g. for test.c
+    filenames = [header_name, source_name] + [unit_filename(name)
+        for namespace in namespaces for name in namespace_unit_names(namespace)]
+    assert len(set(filenames)) == len(filenames), 'sharded units with the same name: %s' % sorted(filenames)
+    clashes = set(filenames) & set(os.path.basename(header) for header in include_headers)
+    assert not clashes, 'sharded units replace included headers: %s' % sorted(clashes)
+
+    native_tables = []
+    namespace_callbacks = []
+    for name, unit in gen_units(namespaces, native_tables, storage=''):
+        if name in namespace_units:
+            unit = [external(line) if isinstance(line, Function) else line for line in unit]
+            namespace_callbacks += [internal(line.prototype) for line in unit if isinstance(line, Function)]
+        yield unit_filename(name), [include] + unit
+
+    program = gen_program(namespaces, native_tables, storage='')
+
+    helper_functions = map(external, program.helper_functions)
+    cache_accessors = [external(line) if isinstance(line, Function) else line for line in program.cache_accessors]
+    get_jni_env = [external(line) if isinstance(line, Function) and line.name == 'get_jni_env' else line
+        for line in GET_JNI_ENV]
+
+    guard = re.sub(r'\W', '_', header_name).upper()
+    yield header_name, [
+        ['#ifndef ' + guard, '#define ' + guard],
+        gen_includes(include_headers),
+        HEADER,
+        JOBJECT_WRAPPER_STRUCTS,
+        config.LAZY_CONTAINER_FUNCTIONS and NATIVE_CONTAINER_STRUCTS,
+        [C.Decl('extern G_GNUC_INTERNAL ' + decl.type, decl.name) for decl in program.cache_declarations if decl and not config.LAZY_CACHE],
+        [internal(func.prototype) for func in cache_accessors if isinstance(func, Function)],
+        runtime_globals('extern G_GNUC_INTERNAL'),
+        [internal(line.prototype) for line in get_jni_env if isinstance(line, Function) and not line.modifiers],
+        [internal(func.prototype) for func in helper_functions],
+        namespace_callbacks,
+        [C.Decl(table.declaration.type.replace('extern ', 'extern G_GNUC_INTERNAL '), table.declaration.name)
+            for table in program.native_tables],
+        '#endif /* ' + guard + ' */',
+    ]
 
+    yield source_name, [
+        include,
+        program.cache_declarations,
+        runtime_globals(''),
+        get_jni_env,
+        config.LAZY_CACHE and CLASS_LOADER,
+        cache_accessors,
+        program.jni_onload,
+        program.java_class_lookup,
+    ] + helper_functions + [program.native_destructor, program.native_containers, program.native_registration]
 
 
 HEADER = """
@@ -693,9 +1256,54 @@ HEADER = """
 #define log_error(st, ...) __android_log_print(ANDROID_LOG_ERROR, "{0}", "["G_STRINGIFY(__LINE__)"]: "st, ##__VA_ARGS__);
 """.format(config.LOG_TAG)
 
+JOBJECT_WRAPPER_STRUCTS = [
+    C.Block(
+        _start = 'typedef union {',
+        body = [
+            C.Decl('jobject', 'obj'),
+            C.Decl('jweak', 'weak'),
+        ],
+        _end = '} JObjectWrapper;',
+    ),
+    '',
+    C.Block(
+        _start = 'typedef struct {',
+        body = [
+            C.Decl('JObjectWrapper', '*wrapper'),
+            C.Decl('gboolean', 'should_destroy'),
+        ],
+        _end = '} JObjectCallbackWrapper;',
+    ),
+]
+
+# Used by config.LAZY_CONTAINER_FUNCTIONS, the items of a NativeList or NativeMap.
+# The items of a map are stored as pairs of a key and a value.
+NATIVE_CONTAINER_STRUCTS = [
+    'typedef jobject (*NativeContainerItemToJava)(JNIEnv* env, gpointer item);',
+    '',
+    C.Block(
+        _start = 'typedef struct {',
+        body = [
+            C.Decl('gpointer*', 'items'),
+            C.Decl('jsize', 'length'),
+            C.Decl('NativeContainerItemToJava', 'key_to_java'),
+            C.Decl('NativeContainerItemToJava', 'value_to_java'),
+            C.Decl('GDestroyNotify', 'free_item'),
+            C.Decl('gpointer', 'container'),
+            C.Decl('GDestroyNotify', 'free_container'),
+        ],
+        _end = '} NativeContainer;',
+    ),
+]
+
 GET_JNI_ENV = [
     C.Decl('static JavaVM*', 'jvm'),
     C.Decl('static pthread_key_t', 'pthread_detach_key = 0'),
+    C.Decl('static pthread_once_t', 'pthread_detach_key_once = PTHREAD_ONCE_INIT'),
+    # the env of each thread is looked up once, then served from thread local storage
+    C.Decl('static __thread JNIEnv*', 'thread_env = NULL'),
+    C.Decl('static volatile gint', 'thread_attach_count = 0'),
+    C.Decl('static volatile gint', 'thread_detach_count = 0'),
     '',
     C.Function('detach_current_thread',
         params=['void* pthread_key'],
@@ -703,13 +1311,26 @@ GET_JNI_ENV = [
             C.Decl('(void)', 'pthread_key'),
             C.Call('g_return_if_fail', 'jvm'),
             '',
-            C.Log.debug('JNI: detaching current thread from Java VM: %ld', C.Call('pthread_self')),
+            C.Call('g_atomic_int_inc', '&thread_detach_count'),
+            C.Log.debug('JNI: detaching current thread from Java VM: %ld (attached: %d, detached: %d)', C.Call('pthread_self'),
+                C.Call('g_atomic_int_get', '&thread_attach_count'), C.Call('g_atomic_int_get', '&thread_detach_count')),
             '',
             C.Call('(*jvm)->DetachCurrentThread', 'jvm'),
             C.Call('pthread_setspecific', 'pthread_detach_key', 'NULL'),
+            C.Assign('thread_env', 'NULL'),
         ]
     ),
     '',
+    C.Function('create_detach_key',
+        params=['void'],
+        body=[
+            C.If(C.Call('pthread_key_create', '&pthread_detach_key', 'detach_current_thread'),
+                C.Log.error('JNI: failed to create detach key')),
+        ]
+    ),
+    '',
+    # Threads are attached as daemons the first time they need an env, and stay
+    # attached until they exit, when the detach key destructor detaches them
     C.Function('get_jni_env',
         return_type='JNIEnv*',
         params=[],
@@ -717,17 +1338,20 @@ GET_JNI_ENV = [
             C.Decl('JNIEnv*', 'env'),
             C.Decl('int', 'ret'),
             '',
+            C.If(C.Call('G_LIKELY', 'thread_env'), C.Return('thread_env')),
+            '',
             C.Assign('env', 'NULL'),
             C.Assign('ret', C.Call('(*jvm)->GetEnv', 'jvm', '(void**)&env', 'JNI_VERSION_1_6')),
             '',
             C.IfElse(ifs=['ret == JNI_EDETACHED', 'ret == JNI_EVERSION'],
                 bodies=[
-                    C.IfElse(ifs=['(*jvm)->AttachCurrentThread(jvm, (JNIEnv**) &env, NULL) != 0'],
+                    C.IfElse(ifs=['(*jvm)->AttachCurrentThreadAsDaemon(jvm, (JNIEnv**) &env, NULL) != 0'],
                         bodies=[
                             C.Log.error('JNI: failed to attach thread'), [
-                                C.Log.info('JNI: successfully attached to thread'),
-                                C.If(C.Call('pthread_key_create', '&pthread_detach_key', 'detach_current_thread'),
-                                    C.Log.error('JNI: failed to set detach callback')),
+                                C.Call('g_atomic_int_inc', '&thread_attach_count'),
+                                C.Log.info('JNI: successfully attached to thread (attached: %d, detached: %d)',
+                                    C.Call('g_atomic_int_get', '&thread_attach_count'), C.Call('g_atomic_int_get', '&thread_detach_count')),
+                                C.Call('pthread_once', '&pthread_detach_key_once', 'create_detach_key'),
                                 C.Call('pthread_setspecific', 'pthread_detach_key', 'jvm'),
                             ]
                         ]),
@@ -736,7 +1360,63 @@ GET_JNI_ENV = [
             ),
             '',
             C.Assert('env'),
+            C.Assign('thread_env', 'env'),
             C.Return('env'),
         ]
     ),
 ]
+
+# Used by --lazy-cache. Threads attached from native code only see the system
+# class loader, so the loader of the library is looked up in JNI_OnLoad and used
+# to load classes from any thread.
+CLASS_LOADER = [
+    C.Decl('static jobject', 'class_loader'),
+    C.Decl('static jmethodID', 'class_loader_load_class'),
+    '',
+    C.Function('cache_class_loader',
+        return_type='gboolean',
+        params=['JNIEnv* env'],
+        body=[
+            C.Decl('jclass', 'clazz'),
+            C.Decl('jclass', 'class_class'),
+            C.Decl('jclass', 'loader_class'),
+            C.Decl('jmethodID', 'get_class_loader'),
+            C.Decl('jobject', 'loader'),
+            '',
+            C.Assign('clazz', C.Env('FindClass', quot(type_signatures['NativeInstance']['_path']))),
+            C.ExceptionCheck('FALSE'),
+            C.Assign('class_class', C.Env('GetObjectClass', 'clazz')),
+            C.Assign('get_class_loader', C.Env('GetMethodID', 'class_class', quot('getClassLoader'), quot('()Ljava/lang/ClassLoader;'))),
+            C.ExceptionCheck('FALSE'),
+            C.Assign('loader', C.Env('CallObjectMethod', 'clazz', 'get_class_loader')),
+            C.ExceptionCheck('FALSE'),
+            C.Assign('loader_class', C.Env('FindClass', quot('java/lang/ClassLoader'))),
+            C.ExceptionCheck('FALSE'),
+            C.Assign('class_loader_load_class', C.Env('GetMethodID', 'loader_class', quot('loadClass'), quot('(Ljava/lang/String;)Ljava/lang/Class;'))),
+            C.ExceptionCheck('FALSE'),
+            C.Assign('class_loader', C.Env('NewGlobalRef', 'loader')),
+            '',
+            C.Env('DeleteLocalRef', 'loader_class'),
+            C.Env('DeleteLocalRef', 'loader'),
+            C.Env('DeleteLocalRef', 'class_class'),
+            C.Env('DeleteLocalRef', 'clazz'),
+            C.Return('class_loader != NULL'),
+        ]
+    ),
+    '',
+    C.Function('load_class',
+        return_type='jclass',
+        params=['JNIEnv* env', 'const gchar* name'],
+        body=[
+            C.Decl('jstring', 'j_name'),
+            C.Decl('jclass', 'clazz'),
+            '',
+            C.Assign('j_name', C.Env('NewStringUTF', 'name')),
+            C.ExceptionPending('NULL'),
+            C.Assign('clazz', C.Env('CallObjectMethod', 'class_loader', 'class_loader_load_class', 'j_name'), cast='jclass'),
+            C.Env('DeleteLocalRef', 'j_name'),
+            C.ExceptionPending('NULL'),
+            C.Return('clazz'),
+        ]
+    ),
+]
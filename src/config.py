@@ -35,3 +35,28 @@ C_INDENTATION = ' ' * 4
 JAVA_INDENTATION = ' ' * 4
 
 LOCAL_FRAME_SIZE = 16
+
+# Size of the stack buffers that string parameters are copied to, longer strings go to the heap
+STRING_BUFFER_SIZE = 256
+
+# Size in bytes of the stack buffers that short primitive arrays are copied to
+ARRAY_BUFFER_SIZE = 256
+
+# C functions that neither block nor call back into Java, their primitive array
+# parameters are accessed in place with GetPrimitiveArrayCritical
+CRITICAL_ARRAY_FUNCTIONS = [
+    # 'c_identifier_of_function_here',
+]
+
+# C functions that return their GList, GSList or GHashTable as a NativeList or NativeMap,
+# which converts the items to Java when they are read instead of all at once
+LAZY_CONTAINER_FUNCTIONS = [
+    # 'c_identifier_of_function_here',
+]
+
+# Resolve cached classes, methods and fields on first use instead of in JNI_OnLoad
+LAZY_CACHE = False
+
+# None to export every native method by name, 'onload' to register them all from
+# JNI_OnLoad, or 'class' to register the methods of each class when it is initialized
+REGISTER_NATIVES = None
@@ -26,9 +26,13 @@
 import re
 import os
 import sys
+import json
+import time
 import errno
 import copy
+import hashlib
 import argparse
+import multiprocessing
 import xml.etree.ElementTree as ET
 import config
 
@@ -49,6 +53,27 @@ parser.add_argument('--package-root', dest = 'package_root', metavar = 'PACKAGE_
                     help = 'the Java package root for generated code')
 parser.add_argument('--log-tag', dest = 'log_tag', metavar = 'LOG_TAG',
                     help = 'the Android log tag to use in debug output')
+parser.add_argument('--skip-docs', dest = 'skip_docs', action = 'store_true',
+                    help = 'do not read documentation from the .gir files')
+parser.add_argument('--check-model', dest = 'check_model', action = 'store_true',
+                    help = 'check that the streamed .gir parsing gives the same model as ET.parse(), and exit')
+parser.add_argument('--cache-dir', dest = 'cache_dir', metavar = 'DIR',
+                    help = 'directory for caching the parsed model between runs')
+parser.add_argument('--manifest', dest = 'manifest', metavar = 'FILE',
+                    help = 'content hash manifest, enables incremental output')
+parser.add_argument('--shard-c', dest = 'shard_c', action = 'store_true',
+                    help = 'split the C output into a header, a runtime source and one source per class')
+parser.add_argument('--jobs', dest = 'jobs', metavar = 'N', type = int, default = 1,
+                    help = 'number of processes used to parse the .gir files and render the java classes')
+parser.add_argument('--profile', dest = 'profile', metavar = 'FILE',
+                    help = 'write wall time and peak memory of each phase to FILE as JSON')
+parser.add_argument('--all-namespaces', dest = 'all_namespaces', action = 'store_true',
+                    help = 'generate bindings for the namespaces of all .gir files, not only the last one')
+parser.add_argument('--lazy-cache', dest = 'lazy_cache', action = 'store_true',
+                    help = 'look up cached classes and method ids on first use instead of in JNI_OnLoad')
+parser.add_argument('--register-natives', dest = 'register_natives', choices = ['onload', 'class'],
+                    help = 'register the native methods with RegisterNatives, from JNI_OnLoad or from the '
+                    'static initializer of each class, and export only JNI_OnLoad')
 args = parser.parse_args()
 
 if args.gir:
@@ -73,17 +98,25 @@ if args.log_tag:
     config.LOG_TAG = args.log_tag
 else:
     print 'missing log tag (--log-tag)'
+if args.lazy_cache:
+    config.LAZY_CACHE = True
+if args.register_natives:
+    config.REGISTER_NATIVES = args.register_natives
+if args.manifest:
+    print 'incremental output using manifest "{}"'.format(args.manifest)
 
 args.c_dir, args.c_file = os.path.split(args.c_path)
 if not args.c_file:
     print('no filename given for C source')
     sys.exit(-1)
 
-if not all(args.__dict__.values()):
+REQUIRED_ARGS = ['gir', 'c_path', 'j_dir', 'headers', 'package_root', 'log_tag']
+
+if not all(getattr(args, name) for name in REQUIRED_ARGS):
     print "all arguments must be set"
     sys.exit(-1)
 
-def write_file(content, path, filename):
+def make_dirs(path):
     try:
         os.makedirs(path)
     except OSError as e:
@@ -91,9 +124,109 @@ def write_file(content, path, filename):
             pass
         else:
             raise
-    outfile = open(path + os.sep + filename, 'w')
-    outfile.write(content)
-    outfile.close()
+
+
+# With a manifest, files whose content hash is unchanged since the last run are
+# not rewritten (keeping their mtime), and files from the last run that are no
+# longer generated are removed. Paths in the manifest are relative to it, and only
+# files inside the output roots are ever removed.
+class OutputWriter(object):
+    def __init__(self, manifest_path=None, roots=()):
+        self.manifest_path = manifest_path
+        self.manifest_dir = os.path.dirname(os.path.abspath(manifest_path)) if manifest_path else None
+        self.roots = [os.path.abspath(root) for root in roots]
+        self.previous = {}
+        self.current = {}
+        self.written = 0
+        self.skipped = 0
+        if manifest_path and os.path.isfile(manifest_path):
+            with open(manifest_path) as manifest:
+                try:
+                    self.previous = json.load(manifest)
+                except ValueError:
+                    print('ignoring unreadable manifest: ' + manifest_path)
+
+    def open(self, path, filename):
+        make_dirs(path)
+        return OutputFile(self, os.path.normpath(path + os.sep + filename))
+
+    def write_file(self, content, path, filename):
+        with self.open(path, filename) as outfile:
+            outfile.write(content)
+
+    def manifest_key(self, filepath):
+        return os.path.relpath(os.path.abspath(filepath), self.manifest_dir)
+
+    def in_roots(self, filepath):
+        return any(filepath.startswith(os.path.join(root, '')) for root in self.roots)
+
+    def commit(self, filepath, tmp_path, digest):
+        if self.manifest_path:
+            key = self.manifest_key(filepath)
+            self.current[key] = digest
+            if self.previous.get(key) == digest and os.path.isfile(filepath):
+                os.remove(tmp_path)
+                self.skipped += 1
+                return
+
+        os.rename(tmp_path, filepath)
+        self.written += 1
+
+    def finish(self):
+        if not self.manifest_path:
+            return
+
+        removed = 0
+        for key in sorted(set(self.previous) - set(self.current)):
+            filepath = os.path.normpath(os.path.join(self.manifest_dir, key))
+            if not self.in_roots(filepath):
+                print('not removing stale output outside of the output directories: ' + filepath)
+            elif os.path.isfile(filepath):
+                print('removing stale output: ' + filepath)
+                os.remove(filepath)
+                removed += 1
+
+        make_dirs(self.manifest_dir)
+        with open(self.manifest_path, 'w') as manifest:
+            json.dump(self.current, manifest, indent=4, sort_keys=True)
+
+        print('wrote {} files, {} unchanged, {} removed'.format(self.written, self.skipped, removed))
+
+
+# Output is streamed to a temporary file while it is hashed, and only moved in
+# place on close() if the content changed.
+class OutputFile(object):
+    def __init__(self, writer, filepath):
+        self.writer = writer
+        self.filepath = filepath
+        self.tmp_path = filepath + '.tmp'
+        self.digest = hashlib.sha1()
+        self.write_time = 0.0
+        self.file = open(self.tmp_path, 'w', 1 << 16)
+
+    def write(self, data):
+        start = time.time() if profiler.enabled else None
+        self.digest.update(data)
+        self.file.write(data)
+        if start is not None:
+            self.write_time += time.time() - start
+
+    def close(self):
+        start = time.time()
+        self.file.close()
+        self.writer.commit(self.filepath, self.tmp_path, self.digest.hexdigest())
+        if profiler.enabled:
+            profiler.add_time('write', self.write_time + time.time() - start)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            self.file.close()
+            os.remove(self.tmp_path)
 
 
 # These are imported after argument parsing so we can set package root and log tag
@@ -101,12 +234,17 @@ import c_generator
 import java_generator
 from c_generator import C
 from gir_parser import GirParser
+from gir_parser import remove_ignored_elements
 from type_registry import TypeRegistry
 from type_registry import TypeTransform
 from type_registry import GirMetaType
+from model_cache import ModelCache
+from profiler import profiler
+from profiler import run_profiled
 from standard_types import standard_types
 from standard_types import ObjectMetaType
 
+profiler.enabled = bool(args.profile)
 
 HEADERS = [
     'android/native_window_jni.h',
@@ -127,15 +265,114 @@ class WindowHandleType(ObjectMetaType(
         ])
 
 
-def remove_ignored_elements(xml_root):
-    def remove_elem(path):
-        parent = xml_root.find(path + '/..')
-        elem = xml_root.find(path)
-        if parent is not None:
-            parent.remove(elem)
+def load_gir(gir):
+    with profiler.phase('xml_load'):
+        return GirParser.iterparse(gir, skip_docs=args.skip_docs, ignored_elements=config.IGNORED_ELEMENTS)
+
+
+def load_gir_tree(gir):
+    # the complete tree without streaming or pruning, which the streamed model is checked against
+    gir_parser = GirParser(ET.parse(gir).getroot())
+    remove_ignored_elements(gir_parser.xml_root, config.IGNORED_ELEMENTS)
+    return gir_parser
+
+
+def load_gir_profiled(gir):
+    return run_profiled(load_gir, gir)
+
+
+def load_girs(girs, jobs):
+    # The pruned element trees are small enough to be sent back from the workers
+    if jobs <= 1 or len(girs) < 2:
+        return map(load_gir, girs)
+
+    pool = multiprocessing.Pool(min(jobs, len(girs)))
+    try:
+        results = pool.map(load_gir_profiled, girs)
+    finally:
+        pool.close()
+        pool.join()
+
+    for _, phases in results:
+        profiler.merge(phases)
+    return [gir_parser for gir_parser, _ in results]
+
+
+def parse_model(load=load_girs):
+    type_registry = TypeRegistry()
+    type_registry.register(standard_types)
+    type_registry.register(WindowHandleType)
+
+    gir_parsers = load(args.gir, args.jobs)
+
+    # All types are registered before any namespace is parsed, so that
+    # references between namespaces resolve regardless of the .gir order
+    with profiler.phase('parse_types'):
+        for gir_parser in gir_parsers:
+            types, enum_aliases, ignored_types = gir_parser.parse_registry()
+            type_registry.register(types)
+            type_registry.register_enum_aliases(enum_aliases)
+            type_registry.register_ignored_types(ignored_types)
+
+    with profiler.phase('parse_full'):
+        if args.all_namespaces:
+            namespaces = sum([gir_parser.parse_full(type_registry) for gir_parser in gir_parsers], [])
         else:
-            print('ignored element was not found: ' + path)
-    [remove_elem(path) for path in config.IGNORED_ELEMENTS]
+            namespaces = gir_parsers[-1].parse_full(type_registry)
+
+    return type_registry, namespaces
+
+
+def dump_model(model):
+    # A structural dump of the model. Objects that are reachable more than once
+    # are dumped the first time and referenced by the order they were seen in after that.
+    seen = {}
+    def dump(value):
+        if value is None or isinstance(value, (basestring, bool, int, long, float)):
+            return value
+        if isinstance(value, (list, tuple)):
+            return [dump(v) for v in value]
+        if isinstance(value, dict):
+            return sorted((dump(k), dump(v)) for k, v in value.items())
+        if isinstance(value, type):
+            return value.__name__
+        if id(value) in seen:
+            return ('seen', seen[id(value)])
+        seen[id(value)] = len(seen)
+        return (type(value).__name__, [(k, dump(v)) for k, v in sorted(vars(value).items())])
+    return dump(model)
+
+
+def check_model():
+    # the streaming front end has to give the same namespaces as a plain ET.parse()
+    args.skip_docs = False
+    _, expected = parse_model(load=lambda girs, jobs: map(load_gir_tree, girs))
+    _, namespaces = parse_model()
+    if dump_model(namespaces) != dump_model(expected):
+        print('the streamed model differs from the ET.parse() model')
+        return 1
+    print('the streamed model is the same as the ET.parse() model')
+    return 0
+
+
+def load_model():
+    if not args.cache_dir:
+        return parse_model()
+
+    model_cache = ModelCache(args.cache_dir)
+    # The modules defining the model, their sources are part of the cache key
+    modules = [sys.modules[name] for name in [__name__, 'gir_parser', 'standard_types', 'type_registry']]
+    key = model_cache.key(args.gir, modules, args.skip_docs, args.all_namespaces)
+
+    with profiler.phase('model_cache'):
+        model = model_cache.load(key)
+    if model is not None:
+        print('using cached model "{}"'.format(model_cache.path(key)))
+        return model
+
+    model = parse_model()
+    model_cache.store(key, model)
+    return model
 
 
 def main(argv = None):
@@ -144,36 +381,46 @@ def main(argv = None):
 
     print('-------- BEGIN ---------')
 
-    type_registry = TypeRegistry()
-    type_registry.register(standard_types)
-    type_registry.register(WindowHandleType)
+    if args.check_model:
+        return check_model()
 
-    for gir in args.gir:
-        xml_root = ET.parse(gir).getroot()
-        remove_ignored_elements(xml_root)
-        gir_parser = GirParser(xml_root)
-        type_registry.register(gir_parser.parse_types())
-        type_registry.register_enum_aliases(gir_parser.parse_enum_aliases())
-        type_registry.register_ignored_types(gir_parser.parse_ignored_types())
+    type_registry, namespaces = load_model()
 
-    namespaces = gir_parser.parse_full(type_registry)
+    output = OutputWriter(args.manifest, roots=[args.c_dir, args.j_dir])
 
     java_base_dir = '/'.join([args.j_dir] + config.PACKAGE_ROOT.split('.'))
     for name, source in java_generator.standard_classes.items():
-        write_file(source, java_base_dir, name + '.java')
+        output.write_file(source, java_base_dir, name + '.java')
 
     for namespace in namespaces:
-        classes = java_generator.gen_namespace(namespace)
         java_namespace_dir = java_base_dir + '/' + namespace.symbol_prefix
 
-        for name, source in classes.items():
-            write_file(source, java_namespace_dir, name + '.java')
+        with profiler.phase('java:' + namespace.name):
+            for name, source in java_generator.iter_namespace(namespace, args.jobs):
+                output.write_file(source, java_namespace_dir, name + '.java')
 
-    source = c_generator.gen_source(namespaces, HEADERS + args.headers)
+    with profiler.phase('c'):
+        write_c_source(output, namespaces)
 
-    write_file(source, args.c_dir, args.c_file)
+    output.finish()
+
+    if args.profile:
+        profiler.count_model(namespaces, type_registry)
+        profiler.write(args.profile)
+        print('wrote profile to "{}"'.format(args.profile))
     print('--------  END  ---------')
 
 
+def write_c_source(output, namespaces):
+    if args.shard_c:
+        header_name = os.path.splitext(args.c_file)[0] + '.h'
+        for filename, body in c_generator.gen_sharded_source(namespaces, HEADERS + args.headers, header_name, args.c_file):
+            with output.open(args.c_dir, filename) as out:
+                c_generator.write_body(body, out)
+    else:
+        with output.open(args.c_dir, args.c_file) as out:
+            c_generator.write_source(namespaces, HEADERS + args.headers, out)
+
+
 if __name__ == "__main__":
     sys.exit(main())
@@ -25,9 +25,13 @@
 from __future__ import print_function
 import xml.etree.ElementTree as ET
 import itertools
+import config
+from collections import defaultdict
 from standard_types import VoidType, IntType, LongPtrType, GParamSpecType, JObjectWrapperType
 from standard_types import ClassCallbackMetaType, GObjectMetaType, CallbackMetaType, OpaqueStructMetaType, ObjectArrayMetaType
 from standard_types import EnumMetaType, BitfieldMetaType, GWeakRefType, JDestroyType
+from standard_types import DirectBufferType, BufferOffsetType, NumericListArrayType, PrimitiveMetaType
+from standard_types import NativeContainerType, BitfieldMaskType
 from standard_types import standard_types
 from copy import copy
 
@@ -212,15 +216,26 @@ class Parameters(object):
         if java_params:
             self.java_params = java_params
 
+        # the items of containers are converted within the function as well
         def set_parent(param):
             if param is not None:
                 param.parent = self
+                map(set_parent, getattr(param, 'inner_values', []))
 
         map(set_parent, [return_value, instance_param] + params)
 
     def __iter__(self):
         return iter(self.all_params)
 
+    def copy_params(self):
+        # copies of the parameters for a variant of the function, with the array lengths relinked
+        params = map(copy, self.params)
+        for param in params:
+            if getattr(param, 'length', None) is not None:
+                param.length = params[self.params.index(param.length)]
+                param.length.array = param
+        return params
+
     @classmethod
     def from_tag(cls, type_registry, tag, namespace=None):
         return_value = parse_tag_value(type_registry, tag.find(TAG_RETURN_VALUE), 'result', namespace=namespace)
@@ -349,12 +364,88 @@ class BaseFunction(object):
         self.c_name = c_name
         self.params = params
         self.doc = doc
+        # lets the types pick a marshalling strategy for the function they are passed to
+        for param in params:
+            param.function_name = c_name
+        # the container is handed to Java as a view that converts its items on demand
+        if c_name in config.LAZY_CONTAINER_FUNCTIONS and NativeContainerType.supports(params.return_value):
+            params.return_value = NativeContainerType(params.return_value)
+            params.return_value.parent = params
 
     @property
     def method_signature(self):
         arg_signature = ''.join((p.java_signature for p in self.params.java_params if p.java_signature is not None))
         return '(' + arg_signature + ')' + self.params.return_value.java_signature
 
+    def direct_buffer_variant(self):
+        # A copy of the function that takes a direct ByteBuffer, an offset and a length
+        # in place of a byte array, so that the native side can read the buffer in place
+        arrays = [param for param in self.params.java_params if param.jni_type == 'jbyteArray'
+            and getattr(param, 'length', None) is not None and not param.transfer_ownership]
+        if len(arrays) != 1:
+            return None
+        array = arrays[0]
+
+        params = self.params.copy_params()
+        offset = BufferOffsetType(array.name + '_offset')
+        buffer = DirectBufferType(params[self.params.params.index(array)], offset)
+        params[self.params.params.index(array)] = buffer
+
+        java_params = []
+        for param in self.params.java_params:
+            if param is array:
+                java_params += [buffer, offset, buffer.length]
+            else:
+                java_params.append(params[self.params.params.index(param)])
+
+        instance_param = self.params.instance_param and copy(self.params.instance_param)
+        variant = type(self)(
+            name=self.name + 'Direct',
+            c_name=self.c_name,
+            params=Parameters(copy(self.params.return_value), instance_param, params, java_params),
+        )
+        variant.buffer = buffer
+        return variant
+
+    def numeric_array_variant(self):
+        # A copy of the function that returns a list of numbers as an int[] or a long[]
+        value = self.params.return_value
+        if isinstance(value, NativeContainerType):
+            value = value.container
+        if not value.is_container or not value.c_type or value.c_type.rstrip('*') not in ['GList', 'GSList']:
+            return None
+        inner = value.inner_value
+        if not isinstance(inner, PrimitiveMetaType) or inner.jni_type not in ['jint', 'jlong']:
+            return None
+
+        instance_param = self.params.instance_param and copy(self.params.instance_param)
+        return type(self)(
+            name=self.name + 'AsArray',
+            c_name=self.c_name,
+            doc=self.doc,
+            params=Parameters(NumericListArrayType(value), instance_param, self.params.copy_params()),
+        )
+
+    def bitfield_mask_variant(self):
+        # A copy of the function that takes and returns its bitfields as int masks,
+        # a Java wrapper converts them from and to an EnumSet
+        value = self.params.return_value
+        if not any(isinstance(param, BitfieldMetaType) for param in [value] + self.params.java_params):
+            return None
+
+        def mask(param):
+            return BitfieldMaskType(param) if isinstance(param, BitfieldMetaType) else param
+
+        instance_param = self.params.instance_param and copy(self.params.instance_param)
+        return type(self)(
+            name=self.name + 'Mask',
+            c_name=self.c_name,
+            params=Parameters(mask(copy(value)), instance_param, map(mask, self.params.copy_params())),
+        )
+
+    def variants(self):
+        return filter(None, [self.direct_buffer_variant(), self.numeric_array_variant()])
+
     @classmethod
     def from_tag(cls, type_registry, tag, namespace=None):
         return cls(
@@ -572,82 +663,235 @@ class Namespace(object):
         self.identifier_prefix = tag.get(ATTR_C_IDENTIFIER_PREFIXES)
         self.shared_library = tag.get(ATTR_SHARED_LIBRARY)
 
-        interfaces = [Class.from_tag(type_registry, t, namespace=self.name) for t in tag.findall(TAG_INTERFACE)]
+        interfaces = [Class.from_tag(type_registry, t, namespace=self.name) for t in consume(tag.findall(TAG_INTERFACE))]
         interface_map = {interface.name: interface for interface in interfaces}
 
         self.interfaces = interfaces
         self.enums = [Enum.from_tag(type_registry, *tags, namespace=self.name) for tags in find_enum_pairs()]
-        self.callbacks = [Callback.from_tag(type_registry, t, namespace=self.name) for t in tag.findall(TAG_CALLBACK)]
-        self.classes = [Class.from_tag(type_registry, t, interface_map, namespace=self.name) for t in tag.findall(TAG_CLASS) if not type_registry.is_ignored(namespacify(self.name, t.get(ATTR_NAME)))]
-        self.functions = [Function.from_tag(type_registry, t, namespace=self.name) for t in tag.findall(TAG_FUNCTION)]
+        self.callbacks = [Callback.from_tag(type_registry, t, namespace=self.name) for t in consume(tag.findall(TAG_CALLBACK))]
+        self.classes = [Class.from_tag(type_registry, t, interface_map, namespace=self.name) for t in consume(tag.findall(TAG_CLASS)) if not type_registry.is_ignored(namespacify(self.name, t.get(ATTR_NAME)))]
+        self.functions = [Function.from_tag(type_registry, t, namespace=self.name) for t in consume(tag.findall(TAG_FUNCTION))]
+
+
+# Namespace children that are read while parsing, everything else is dropped
+# by the streaming front end
+PARSED_TAGS = set([
+    TAG_CLASS,
+    TAG_INTERFACE,
+    TAG_CALLBACK,
+    TAG_ENUMERATION,
+    TAG_BITFIELD,
+    TAG_RECORD,
+    TAG_FUNCTION,
+])
+
+# Descendants that are never read while parsing
+UNUSED_TAGS = set([
+    TAG_FIELD,
+    TAG_VIRTUAL_METHOD,
+    NS + 'attribute',
+    NS + 'source-position',
+    NS + 'doc-version',
+    NS + 'doc-stability',
+    NS + 'doc-deprecated',
+])
+
+REGISTRY_TAG_TYPES = {
+    TAG_CLASS: GObjectMetaType,
+    TAG_INTERFACE: GObjectMetaType,
+    TAG_CALLBACK: CallbackMetaType,
+    TAG_ENUMERATION: EnumMetaType,
+    TAG_BITFIELD: BitfieldMetaType,
+    TAG_RECORD: OpaqueStructMetaType,
+}
+
+
+def remove_ignored_elements(xml_root, paths):
+    for path in paths:
+        parent = xml_root.find(path + '/..')
+        elem = xml_root.find(path)
+        if parent is not None:
+            parent.remove(elem)
+        else:
+            print('ignored element was not found: ' + path)
+
+
+def prune_element(parent, elem, depth, unused_tags):
+    # depth is 1 for the children of the repository
+    if depth == 1:
+        drop = elem.tag != TAG_NAMESPACE
+    elif depth == 2:
+        drop = elem.tag not in PARSED_TAGS
+        if elem.tag == TAG_RECORD:
+            strip_record(elem)
+    else:
+        drop = elem.tag in unused_tags
+
+    if drop:
+        if len(parent) and parent[-1] is elem:
+            del parent[-1]
+        else:
+            parent.remove(elem)
+        elem.clear()
+    else:
+        if elem.tag != TAG_DOC:
+            elem.text = None
+        elem.tail = None
+
+
+def prune_children(elem, depth, unused_tags):
+    # the same pruning as the streaming front end, applied to a complete tree
+    for child in list(elem):
+        prune_children(child, depth + 1, unused_tags)
+        prune_element(elem, child, depth, unused_tags)
+
+
+def consume(tags):
+    # frees each element once it has been parsed
+    for tag in tags:
+        yield tag
+        tag.clear()
+
+
+def strip_record(tag):
+    # Only the copy and free methods of a record are of interest
+    methods = [ET.Element(TAG_METHOD, method.attrib) for method in tag.iter(TAG_METHOD)
+        if method.get(ATTR_NAME) in ('copy', 'free')]
+    del tag[:]
+    tag.extend(methods)
+
+
+def parse_registry_types(namespace_name, prefix, tag):
+    types = []
+    gir_type = namespacify(namespace_name, tag.get(ATTR_NAME))
+    c_type = tag.get(ATTR_C_TYPE)
+    MetaType = REGISTRY_TAG_TYPES[tag.tag]
+
+    # Fake type to represent a fundamental type - skip
+    if tag.get(ATTR_GLIB_FUNDAMENTAL) is not None:
+         return types
+
+    # Class structure - skip
+    if tag.get(ATTR_GLIB_IS_GTYPE_STRUCT_FOR) is not None:
+         return types
+
+    if (MetaType == OpaqueStructMetaType):
+        copy_func = None
+        free_func = None
+
+        # FIXME: we're hard-coding _copy() and _free() as the
+        # copy/free functions. Is there a better way to do this?
+        for method in tag.iter(TAG_METHOD):
+            name = method.get(ATTR_NAME)
+
+            if name == "copy":
+                copy_func = method.get(ATTR_C_IDENTIFIER)
+            elif name == "free":
+                free_func = method.get(ATTR_C_IDENTIFIER)
+
+        typ = MetaType(
+            gir_type=gir_type,
+            c_type=c_type,
+            prefix=prefix,
+            copy_func=copy_func,
+            free_func=free_func,
+        )
+        types.append(typ)
+        types.append(ObjectArrayMetaType.from_object_type(typ))
+    else:
+        typ = MetaType(
+            gir_type=gir_type,
+            c_type=c_type,
+            prefix=prefix,
+            )
+        types.append(typ)
+
+        # These are simple enough to make array meta types of
+        if MetaType == EnumMetaType or MetaType == BitfieldMetaType:
+            types.append(ObjectArrayMetaType.from_object_type(typ))
+
+    return types
+
+
+def parse_enum_alias(tag):
+    if tag.get(ATTR_GLIB_TYPE_NAME) is not None:
+        alias = tag.get(ATTR_NAME)
+        return alias, alias[:-1]
+    return None
+
+
+def is_ignored_type(tag):
+    return tag.get(ATTR_GLIB_FUNDAMENTAL) is not None
 
 
 class GirParser(object):
     def __init__(self, xml_root):
         self.xml_root = xml_root
 
+    @classmethod
+    def iterparse(cls, source, skip_docs=False, ignored_elements=()):
+        # Streams the document, dropping every element that is never read by
+        # the parser as soon as it has been consumed. The resulting tree gives
+        # the same model as a full ET.parse(), minus docs if skip_docs is set.
+        unused_tags = UNUSED_TAGS | set([TAG_DOC]) if skip_docs else UNUSED_TAGS
+
+        # the ignored paths are looked up in the whole document, so the tree can
+        # only be pruned once they have been removed
+        if ignored_elements:
+            xml_root = ET.parse(source).getroot()
+            remove_ignored_elements(xml_root, ignored_elements)
+            prune_children(xml_root, 1, unused_tags)
+            return cls(xml_root)
+
+        stack = []
+        for event, elem in ET.iterparse(source, events=('start', 'end')):
+            if event == 'start':
+                stack.append(elem)
+                continue
+
+            stack.pop()
+            if not stack:
+                break
+            prune_element(stack[-1], elem, len(stack), unused_tags)
+
+        return cls(elem)
+
+    def parse_registry(self):
+        # Collects the types, enum aliases and ignored types in a single walk
+        types = []
+        aliases = {}
+        ignored = []
+
+        for namespace in self.xml_root.findall(TAG_NAMESPACE):
+            namespace_name = namespace.get(ATTR_NAME)
+            prefix = namespace.get(ATTR_C_SYMBOL_PREFIXES)
+            tags = defaultdict(list)
+            for tag in namespace:
+                tags[tag.tag].append(tag)
+
+            for tag in sum([tags[t] for t in REGISTRY_TAG_TYPES.keys()], []):
+                types += parse_registry_types(namespace_name, prefix, tag)
+
+            for tag in tags[TAG_ENUMERATION] + tags[TAG_BITFIELD]:
+                alias = parse_enum_alias(tag)
+                if alias is not None:
+                    aliases[alias[0]] = alias[1]
+
+            for tag in tags[TAG_CLASS]:
+                if is_ignored_type(tag):
+                    ignored.append(namespacify(namespace_name, tag.get(ATTR_NAME)))
+
+        return types, aliases, ignored
+
     def parse_types(self):
         types = []
 
         for namespace in self.xml_root.findall(TAG_NAMESPACE):
             namespace_name = namespace.get(ATTR_NAME);
             prefix = namespace.get(ATTR_C_SYMBOL_PREFIXES)
-            tag_types = {
-                TAG_CLASS: GObjectMetaType,
-                TAG_INTERFACE: GObjectMetaType,
-                TAG_CALLBACK: CallbackMetaType,
-                TAG_ENUMERATION: EnumMetaType,
-                TAG_BITFIELD: BitfieldMetaType,
-                TAG_RECORD: OpaqueStructMetaType,
-            }
-            tags = sum(map(namespace.findall, tag_types.keys()), [])
+            tags = sum(map(namespace.findall, REGISTRY_TAG_TYPES.keys()), [])
             for tag in tags:
-                gir_type = namespacify(namespace_name, tag.get(ATTR_NAME))
-                c_type = tag.get(ATTR_C_TYPE)
-                MetaType = tag_types[tag.tag]
-
-                # Fake type to represent a fundamental type - skip
-                if tag.get(ATTR_GLIB_FUNDAMENTAL) is not None:
-                     continue
-
-                # Class structure - skip
-                if tag.get(ATTR_GLIB_IS_GTYPE_STRUCT_FOR) is not None:
-                     continue
-
-                if (MetaType == OpaqueStructMetaType):
-                    copy_func = None
-                    free_func = None
-
-                    # FIXME: we're hard-coding _copy() and _free() as the
-                    # copy/free functions. Is there a better way to do this?
-                    for method in tag.iter(TAG_METHOD):
-                        name = method.get(ATTR_NAME)
-
-                        if name == "copy":
-                            copy_func = method.get(ATTR_C_IDENTIFIER)
-                        elif name == "free":
-                            free_func = method.get(ATTR_C_IDENTIFIER)
-
-                    typ = MetaType(
-                        gir_type=gir_type,
-                        c_type=c_type,
-                        prefix=prefix,
-                        copy_func=copy_func,
-                        free_func=free_func,
-                    )
-                    types.append(typ)
-                    types.append(ObjectArrayMetaType.from_object_type(typ))
-                else:
-                    typ = MetaType(
-                        gir_type=gir_type,
-                        c_type=c_type,
-                        prefix=prefix,
-                        )
-                    types.append(typ)
-
-                    # These are simple enough to make array meta types of
-                    if MetaType == EnumMetaType or MetaType == BitfieldMetaType:
-                        types.append(ObjectArrayMetaType.from_object_type(typ))
+                types += parse_registry_types(namespace_name, prefix, tag)
 
         return types
 
@@ -656,10 +900,9 @@ class GirParser(object):
         for namespace in self.xml_root.findall(TAG_NAMESPACE):
             enum_tags = namespace.findall(TAG_ENUMERATION) + namespace.findall(TAG_BITFIELD)
             for tag in enum_tags:
-                if tag.get(ATTR_GLIB_TYPE_NAME) is not None:
-                    alias = tag.get(ATTR_NAME)
-                    name = alias[:-1]
-                    aliases[alias] = name
+                alias = parse_enum_alias(tag)
+                if alias is not None:
+                    aliases[alias[0]] = alias[1]
         return aliases
 
     def parse_ignored_types(self):
@@ -668,7 +911,7 @@ class GirParser(object):
         for namespace in self.xml_root.findall((TAG_NAMESPACE)):
             namespace_name = namespace.get(ATTR_NAME)
             for tag in namespace.findall(TAG_CLASS):
-                if tag.get(ATTR_GLIB_FUNDAMENTAL) is not None:
+                if is_ignored_type(tag):
                      ignored.append(namespacify(namespace_name, tag.get(ATTR_NAME)))
 
         return ignored
@@ -676,5 +919,7 @@ class GirParser(object):
 
 
     def parse_full(self, type_registry):
-        return [Namespace(type_registry, tag) for tag in self.xml_root.findall(TAG_NAMESPACE)]
-
+        # the tree is released as it is parsed, so it can only be parsed once
+        namespaces = [Namespace(type_registry, tag) for tag in consume(self.xml_root.findall(TAG_NAMESPACE))]
+        self.xml_root.clear()
+        return namespaces
@@ -23,6 +23,7 @@
 
 
 import collections
+import multiprocessing
 import config
 from functools import partial
 from base_generator import *
@@ -199,6 +200,62 @@ class Method(J.FunctionBlock):
         return Method(**args)
 
 
+@add_to(J)
+def gen_method(function, static=False):
+    # bitfields cross as int masks, the wrapper converts them from and to an EnumSet
+    variant = function.bitfield_mask_variant()
+    if variant is None:
+        return Method.default(function, static=static)
+    args = [('%s.toMask(%s)' % (param.enum_full_class, param.name) if hasattr(param, 'enum_full_class') else param.name)
+        for param in variant.params.java_params]
+    call = '%s(%s)' % (variant.name, ', '.join(args))
+    ret = variant.params.return_value
+    if hasattr(ret, 'enum_full_class'):
+        call = J.Return('%s.fromMask(%s)' % (ret.enum_full_class, call))
+    elif ret.name is not None:
+        call = J.Return(call)
+    else:
+        call = semi(call)
+    return [
+        Method.default(function, native=False, static=static, body=[call]),
+        '',
+        Method.default(variant, visibility='private', static=static, doc=None),
+    ]
+
+
+@add_to(J)
+def gen_numeric_array_variant(function, static=False):
+    variant = function.numeric_array_variant()
+    if variant is None:
+        return []
+    return Method.default(variant, static=static)
+
+
+@add_to(J)
+def gen_direct_buffer_overload(function, static=False):
+    variant = function.direct_buffer_variant()
+    if variant is None:
+        return []
+    buffer = variant.buffer
+    call = J.Call(variant.name, *map(java_arg, variant.params.java_params))
+    return [
+        Method.default(variant, visibility='private', static=static, doc=None),
+        '',
+        Method.default(function,
+            native=False,
+            static=static,
+            params=map(java_param, variant.params.java_params),
+            body=[
+                J.If('!%s.isDirect()' % buffer.name,
+                    'throw new IllegalArgumentException("%s must be a direct buffer");' % buffer.name),
+                J.If('{0} < 0 || {1} < 0 || {1} > {2}.capacity() - {0}'.format(buffer.offset.name, buffer.length.name, buffer.name),
+                    'throw new IndexOutOfBoundsException();'),
+                J.Return(call) if function.params.return_value.name is not None else call,
+            ],
+        ),
+    ]
+
+
 @add_to(J)
 def gen_signal(signal):
     mapName = 'handleMap' + signal.value.java_type
@@ -235,10 +292,30 @@ def gen_signal(signal):
     ]
 
 
+def register_natives(name):
+    # with --register-natives=class each class registers its native methods when it is initialized
+    return J.Call('NativeInstance._registerNatives', name + '.class')
+
+
+def main_class_name(namespace):
+    return '.'.join([config.PACKAGE_ROOT, namespace.symbol_prefix, namespace.name])
+
+
 @add_to(J)
-def gen_class(clazz, interfaces):
+def gen_class(clazz, interfaces, namespace):
+    has_natives = any([clazz.constructors, clazz.methods, clazz.functions, clazz.signals] +
+        [interface.methods for interface in clazz.interfaces] +
+        [prop.readable or prop.writable for prop in clazz.properties])
+    body = []
+    if config.REGISTER_NATIVES == 'class' and has_natives:
+        # the library is loaded by the main class, which has to be initialized first
+        body += [J.Block(_start='static {', body=[
+            J.Call(main_class_name(namespace) + '._ensureLoaded'),
+            register_natives(clazz.name),
+        ])]
+
     # public constructors
-    body = [(
+    body += [(
         Method(
             visibility='public',
             return_type=[],
@@ -269,11 +346,17 @@ def gen_class(clazz, interfaces):
     )]
 
     # methods
-    body += map(Method.default, clazz.methods)
-    body += map(partial(Method.default, static=True), clazz.functions)
+    body += map(J.gen_method, clazz.methods)
+    body += map(partial(J.gen_method, static=True), clazz.functions)
+
+    # variants
+    body += map(J.gen_numeric_array_variant, clazz.methods)
+    body += map(partial(J.gen_numeric_array_variant, static=True), clazz.functions)
+    body += map(J.gen_direct_buffer_overload, clazz.methods)
+    body += map(partial(J.gen_direct_buffer_overload, static=True), clazz.functions)
 
     # interface methods
-    body += [['@Override', Method.default(method)] for method in flatten(interface.methods for interface in clazz.interfaces)];
+    body += [['@Override', J.gen_method(method)] for method in flatten(interface.methods for interface in clazz.interfaces)];
 
     # properties
     body += sum(sum([[
@@ -332,6 +415,34 @@ def gen_enum(enum):
         enum.has_nick and Method('public', 'String', 'getNick',
             body=['return mNick;'],
         ),
+        enum.is_bitfield and Method(
+            static=True,
+            name='toMask',
+            params=['EnumSet<%s> flags' % enum.name],
+            return_type='int',
+            body=[
+                'int mask = 0;',
+                J.If('flags != null', J.Block(
+                    _start='for (%s flag : flags) {' % enum.name,
+                    body=['mask |= flag.mValue;'],
+                )),
+                J.Return('mask'),
+            ]
+        ),
+        enum.is_bitfield and Method(
+            static=True,
+            name='fromMask',
+            params=['int mask'],
+            return_type='EnumSet<%s>' % enum.name,
+            body=[
+                'EnumSet<{0}> flags = EnumSet.noneOf({0}.class);'.format(enum.name),
+                J.Block(
+                    _start='for (%s flag : values()) {' % enum.name,
+                    body=[J.If('flag.mValue != 0 && (mask & flag.mValue) == flag.mValue', J.Call('flags.add', 'flag'))],
+                ),
+                J.Return('flags'),
+            ]
+        ),
         enum.has_nick and Method(
             static=True,
             name='valueOfNick',
@@ -346,38 +457,89 @@ def gen_enum(enum):
     ]
 
     return J.Class(enum.name, variation='enum',
-        imports=[config.PACKAGE_ROOT + '.ValueEnum'],
+        imports=['java.util.EnumSet'] * enum.is_bitfield + [config.PACKAGE_ROOT + '.ValueEnum'],
         implements=['ValueEnum'],
         body=intersperse(prune_empty(body), ''),
     )
 
 
 @add_to(J)
-def gen_namespace(namespace):
-    classes = map(gen_class, namespace.classes, namespace.interfaces)
-    interfaces = map(gen_interface, namespace.interfaces)
-    enums = map(gen_enum, namespace.enums)
-    callbacks = map(partial(J.Class.create_callback, static=False), namespace.callbacks)
-
-    main_class = J.Class(
+def gen_main_class(namespace):
+    return J.Class(
         name=namespace.name,
+        imports=[config.PACKAGE_ROOT + '.NativeInstance'] if config.REGISTER_NATIVES == 'class' else [],
         body=[
             J.Block(
                 _start='static {',
-                body=['System.loadLibrary("%s");' % namespace.shared_library[3:-3]],
+                body=['System.loadLibrary("%s");' % namespace.shared_library[3:-3]] +
+                    ([register_natives(namespace.name)] if config.REGISTER_NATIVES == 'class' and namespace.functions else []),
             ),
             '',
             Method('private', [], namespace.name, body=['']),
             '',
-        ] + intersperse(map(partial(Method.default, static=True), namespace.functions), '')
+        ] + (config.REGISTER_NATIVES == 'class' and [
+            J.Method('public', 'void', '_ensureLoaded', static=True, body=['']),
+            '',
+        ] or []) + intersperse(prune_empty(map(partial(J.gen_method, static=True), namespace.functions) +
+            map(partial(J.gen_numeric_array_variant, static=True), namespace.functions) +
+            map(partial(J.gen_direct_buffer_overload, static=True), namespace.functions)), '')
     )
 
-    all_classes = classes + interfaces + enums + callbacks + [main_class]
 
-    for clazz in all_classes:
-        clazz.package = config.PACKAGE_ROOT + '.' + namespace.symbol_prefix
+@add_to(J)
+def namespace_builders(namespace):
+    # map() pads the shorter list with None, same as the original serial version
+    builders = [partial(gen_class, clazz, interfaces, namespace) for clazz, interfaces in map(None, namespace.classes, namespace.interfaces)]
+    builders += [partial(gen_interface, interface) for interface in namespace.interfaces]
+    builders += [partial(gen_enum, enum) for enum in namespace.enums]
+    builders += [partial(J.Class.create_callback, callback, static=False) for callback in namespace.callbacks]
+    builders += [partial(gen_main_class, namespace)]
+    return builders
+
 
-    return {c.name: str(c) for c in all_classes}
+def render_class(build, package):
+    clazz = build()
+    clazz.package = package
+    return clazz.name, str(clazz)
+
+
+# Builders of the namespace being rendered by a worker pool, inherited by the
+# forked workers so that the model never has to be pickled
+pool_builders = []
+
+def render_pool_class(index):
+    return render_class(*pool_builders[index])
+
+
+@add_to(J)
+def iter_namespace(namespace, jobs=1):
+    global pool_builders
+    package = config.PACKAGE_ROOT + '.' + namespace.symbol_prefix
+    builders = namespace_builders(namespace)
+
+    if jobs <= 1 or len(builders) < 2:
+        for build in builders:
+            yield render_class(build, package)
+        return
+
+    pool_builders = [(build, package) for build in builders]
+    pool = multiprocessing.Pool(min(jobs, len(builders)))
+    try:
+        chunksize = max(1, len(builders) // (jobs * 4))
+        for result in pool.imap(render_pool_class, range(len(builders)), chunksize):
+            yield result
+        pool.close()
+    except:
+        pool.terminate()
+        raise
+    finally:
+        pool.join()
+        pool_builders = []
+
+
+@add_to(J)
+def gen_namespace(namespace, jobs=1):
+    return dict(iter_namespace(namespace, jobs))
 
 
 standard_classes = {
@@ -386,15 +548,23 @@ standard_classes = {
         visibility='public',
         package=config.PACKAGE_ROOT,
         abstract=True,
+        implements=['AutoCloseable'],
         body=[
             J.Decl('long', 'nativeInstance'),
+            J.Decl('private NativeCleaner.Ref', 'cleanerRef'),
             '',
             J.Method('protected', [], 'NativeInstance', params=['NativePointer nativePointer'],
-                body=[J.Assign('this.nativeInstance', 'nativePointer.pointer')],
+                body=[
+                    J.Assign('this.nativeInstance', 'nativePointer.pointer'),
+                    J.Call('_register'),
+                ],
             ),
             '',
             J.Method('protected', 'void', '_setInternalPointer', params=['long pointer'],
-                body=[J.Assign('nativeInstance', 'pointer')]
+                body=[
+                    J.Assign('nativeInstance', 'pointer'),
+                    J.Call('_register'),
+                ]
             ),
             '',
             J.Method('protected', 'NativePointer', '_newNativePointer', params=['long pointer'],
@@ -402,12 +572,159 @@ standard_classes = {
                 static=True,
             ),
             '',
+            J.Method('private', 'void', '_register', synchronized=True,
+                body=[
+                    J.If('nativeInstance != 0 && cleanerRef == null',
+                        J.Assign('cleanerRef', J.Call('NativeCleaner.register', 'this', 'nativeInstance')),
+                    ),
+                ],
+            ),
+            '',
+            # releases the native instance right away instead of when the wrapper is collected
             '@Override',
-            J.Method('protected', 'void', 'finalize',
-                body=[J.Call('nativeDestructor', 'this.nativeInstance')],
+            J.Method('public', 'void', 'close', synchronized=True,
+                body=[
+                    J.If('cleanerRef != null',
+                        J.Call('cleanerRef.release'),
+                        J.Assign('cleanerRef', 'null'),
+                    ),
+                    J.Assign('nativeInstance', '0'),
+                ],
+            ),
+            '',
+            # drops the pointer without releasing it, the native side keeps ownership
+            J.Method('private', 'void', '_discard', synchronized=True,
+                body=[
+                    J.If('cleanerRef != null',
+                        J.Call('cleanerRef.forget'),
+                        J.Assign('cleanerRef', 'null'),
+                    ),
+                    J.Assign('nativeInstance', '0'),
+                ],
+            ),
+            '',
+            J.Method('default', 'void', 'nativeDestructor', params=['long instancePointer'], static=True, native=True),
+            '',
+            J.Method('default', 'void', 'nativeDestructorBatch', params=['long[] instancePointers', 'int count'], static=True, native=True),
+        ] + (config.REGISTER_NATIVES == 'class' and [
+            '',
+            J.Method('public', 'void', '_registerNatives', params=['Class<?> clazz'], static=True,
+                body=[J.Call('nativeRegisterNatives', 'clazz', "clazz.getName().replace('.', '/')")],
             ),
             '',
-            J.Method('private', 'void', 'nativeDestructor', params=['long instancePointer'], native=True),
+            J.Method('default', 'void', 'nativeRegisterNatives', params=['Class<?> clazz', 'String className'], static=True, native=True),
+        ] or []),
+    )),
+    'NativeCleaner': str(J.Class(
+        name='NativeCleaner',
+        visibility='default',
+        package=config.PACKAGE_ROOT,
+        implements=['Runnable'],
+        imports=[
+            'java.lang.ref.PhantomReference',
+            'java.lang.ref.Reference',
+            'java.lang.ref.ReferenceQueue',
+            'java.util.Collections',
+            'java.util.HashSet',
+            'java.util.Set',
+        ],
+        body=[
+            'private static final int BATCH_SIZE = 64;',
+            '',
+            'private static final ReferenceQueue<Object> queue = new ReferenceQueue<Object>();',
+            '',
+            '// keeps the references reachable until their instance has been released',
+            'private static final Set<Ref> refs = Collections.synchronizedSet(new HashSet<Ref>());',
+            '',
+            'private static Thread thread;',
+            '',
+            J.Class(
+                name='Ref',
+                visibility='default',
+                static=True,
+                extends=['PhantomReference<Object>'],
+                body=[
+                    'final long pointer;',
+                    '',
+                    J.Method('default', [], 'Ref', params=['Object owner', 'long pointer'],
+                        body=[
+                            J.Call('super', 'owner', 'queue'),
+                            J.Assign('this.pointer', 'pointer'),
+                        ],
+                    ),
+                    '',
+                    J.Method('default', 'void', 'forget',
+                        body=[
+                            J.If(J.Call('refs.remove', 'this'), J.Call('clear')),
+                        ],
+                    ),
+                    '',
+                    J.Method('default', 'void', 'release',
+                        body=[
+                            J.If(J.Call('refs.remove', 'this'),
+                                J.Call('clear'),
+                                J.Call('destroy'),
+                            ),
+                        ],
+                    ),
+                    '',
+                    # overridden by refs to anything else than a native instance
+                    J.Method('default', 'void', 'destroy',
+                        body=[J.Call('NativeInstance.nativeDestructor', 'pointer')],
+                    ),
+                ],
+            ),
+            '',
+            J.Method('default', 'Ref', 'register', params=['NativeInstance instance', 'long pointer'], static=True,
+                body=[J.Return(J.Call('register', 'new Ref(instance, pointer)'))],
+            ),
+            '',
+            J.Method('default', 'Ref', 'register', params=['Ref ref'], static=True,
+                body=[
+                    J.Call('refs.add', 'ref'),
+                    J.Call('start'),
+                    J.Return('ref'),
+                ],
+            ),
+            '',
+            J.Method('private', 'void', 'start', static=True, synchronized=True,
+                body=[
+                    J.If('thread == null',
+                        J.Assign('thread', J.Call('new Thread', 'new NativeCleaner()', quot('NativeCleaner'))),
+                        J.Call('thread.setDaemon', 'true'),
+                        J.Call('thread.start'),
+                    ),
+                ],
+            ),
+            '',
+            # blocks until a wrapper has been collected, then releases everything that
+            # is already queued with a single native call per batch
+            '@Override',
+            J.Method('public', 'void', 'run',
+                body=[
+                    'long[] batch = new long[BATCH_SIZE];',
+                    J.While('true',
+                        J.Block(
+                            _start='try {',
+                            body=[
+                                'int count = 0;',
+                                'Reference<?> ref = queue.remove();',
+                                J.While('ref != null',
+                                    J.If(J.Call('refs.remove', 'ref'), J.IfElse(
+                                        ifs=['ref.getClass() == Ref.class'],
+                                        bodies=['batch[count++] = ((Ref) ref).pointer;', '((Ref) ref).destroy();'],
+                                    )),
+                                    J.If('count == BATCH_SIZE', 'break;'),
+                                    J.Assign('ref', J.Call('queue.poll')),
+                                ),
+                                J.If('count > 0', J.Call('NativeInstance.nativeDestructorBatch', 'batch', 'count')),
+                            ],
+                            _end='} catch (InterruptedException e) {',
+                        ),
+                        '}',
+                    ),
+                ],
+            ),
         ],
     )),
     'NativePointer': str(J.Class(
@@ -429,4 +746,262 @@ standard_classes = {
         variation='interface',
         body=[J.Method('public', 'int', 'getValue')],
     )),
+    # builds the lists that are returned from native code with a single call,
+    # numbers are passed as primitive arrays and boxed here
+    'NativeLists': str(J.Class(
+        name='NativeLists',
+        visibility='default',
+        package=config.PACKAGE_ROOT,
+        imports=['java.util.ArrayList'],
+        body=intersperse([
+            J.Method('default', 'ArrayList<%s>' % object_type, 'from%sArray' % name, params=[item_type + '[] items'], static=True,
+                body=[
+                    'ArrayList<{0}> list = new ArrayList<{0}>(items.length);'.format(object_type),
+                    J.Block(
+                        _start='for (%s item : items) {' % item_type,
+                        body=[J.Call('list.add', 'item')],
+                    ),
+                    J.Return('list'),
+                ],
+            ) for name, item_type, object_type in [
+                ('', 'Object', 'Object'),
+                ('Boolean', 'boolean', 'Boolean'),
+                ('Byte', 'byte', 'Byte'),
+                ('Short', 'short', 'Short'),
+                ('Int', 'int', 'Integer'),
+                ('Long', 'long', 'Long'),
+                ('Float', 'float', 'Float'),
+                ('Double', 'double', 'Double'),
+            ]
+        ], ''),
+    )),
 }
+
+
+# the views that are returned by the functions in config.LAZY_CONTAINER_FUNCTIONS
+if config.LAZY_CONTAINER_FUNCTIONS:
+    standard_classes.update({
+        'NativeContainer': str(J.Class(
+            name='NativeContainer',
+            visibility='default',
+            package=config.PACKAGE_ROOT,
+            body=[
+                'private long pointer;',
+                'private NativeCleaner.Ref cleanerRef;',
+                'private final Object[] items;',
+                'private final boolean[] converted;',
+                '',
+                J.Method('default', [], 'NativeContainer', params=['long pointer'],
+                    body=[
+                        J.Assign('this.pointer', 'pointer'),
+                        J.Assign('this.items', 'new Object[nativeLength(pointer)]'),
+                        J.Assign('this.converted', 'new boolean[items.length]'),
+                        J.Assign('this.cleanerRef', J.Call('NativeCleaner.register', 'new FreeRef(this, pointer)')),
+                    ],
+                ),
+                '',
+                J.Method('default', 'int', 'length',
+                    body=[J.Return('items.length')],
+                ),
+                '',
+                # each item is converted the first time it is read
+                J.Method('default', 'Object', 'get', params=['int index'], synchronized=True,
+                    body=[
+                        J.If('!converted[index]',
+                            J.If('pointer == 0', 'throw new IllegalStateException("native container has been closed");'),
+                            J.Assign('items[index]', J.Call('nativeGet', 'pointer', 'index')),
+                            J.Assign('converted[index]', 'true'),
+                        ),
+                        J.Return('items[index]'),
+                    ],
+                ),
+                '',
+                # releases the native container right away instead of when the view is collected
+                J.Method('default', 'void', 'close', synchronized=True,
+                    body=[
+                        J.If('cleanerRef != null',
+                            J.Call('cleanerRef.release'),
+                            J.Assign('cleanerRef', 'null'),
+                        ),
+                        J.Assign('pointer', '0'),
+                    ],
+                ),
+                '',
+                J.Class(
+                    name='FreeRef',
+                    visibility='default',
+                    static=True,
+                    extends=['NativeCleaner.Ref'],
+                    body=[
+                        J.Method('default', [], 'FreeRef', params=['Object owner', 'long pointer'],
+                            body=[J.Call('super', 'owner', 'pointer')],
+                        ),
+                        '',
+                        '@Override',
+                        J.Method('default', 'void', 'destroy',
+                            body=[J.Call('nativeFree', 'pointer')],
+                        ),
+                    ],
+                ),
+                '',
+                J.Method('default', 'int', 'nativeLength', params=['long pointer'], static=True, native=True),
+                '',
+                J.Method('default', 'Object', 'nativeGet', params=['long pointer', 'int index'], static=True, native=True),
+                '',
+                J.Method('default', 'void', 'nativeFree', params=['long pointer'], static=True, native=True),
+            ],
+        )),
+        'NativeList': str(J.Class(
+            name='NativeList<E>',
+            visibility='public',
+            package=config.PACKAGE_ROOT,
+            extends=['AbstractList<E>'],
+            implements=['RandomAccess', 'AutoCloseable'],
+            imports=[
+                'java.util.AbstractList',
+                'java.util.RandomAccess',
+            ],
+            body=[
+                'private final NativeContainer container;',
+                '',
+                J.Method('default', [], 'NativeList', params=['long pointer'],
+                    body=[J.Assign('container', 'new NativeContainer(pointer)')],
+                ),
+                '',
+                '@Override',
+                J.Method('public', 'int', 'size',
+                    body=[J.Return(J.Call('container.length'))],
+                ),
+                '',
+                '@Override',
+                '@SuppressWarnings("unchecked")',
+                J.Method('public', 'E', 'get', params=['int index'],
+                    body=[J.Return('(E) container.get(index)')],
+                ),
+                '',
+                # frees the native list, the items that have already been read stay valid
+                '@Override',
+                J.Method('public', 'void', 'close',
+                    body=[J.Call('container.close')],
+                ),
+            ],
+        )),
+        'NativeMap': str(J.Class(
+            name='NativeMap<K, V>',
+            visibility='public',
+            package=config.PACKAGE_ROOT,
+            extends=['AbstractMap<K, V>'],
+            implements=['AutoCloseable'],
+            imports=[
+                'java.util.AbstractMap',
+                'java.util.AbstractSet',
+                'java.util.Iterator',
+                'java.util.Map',
+                'java.util.NoSuchElementException',
+                'java.util.Set',
+            ],
+            body=[
+                'private final NativeContainer container;',
+                '',
+                J.Method('default', [], 'NativeMap', params=['long pointer'],
+                    body=[J.Assign('container', 'new NativeContainer(pointer)')],
+                ),
+                '',
+                '@Override',
+                J.Method('public', 'int', 'size',
+                    body=[J.Return('container.length() / 2')],
+                ),
+                '',
+                '@SuppressWarnings("unchecked")',
+                J.Method('private', 'K', 'key', params=['int index'],
+                    body=[J.Return('(K) container.get(2 * index)')],
+                ),
+                '',
+                '@SuppressWarnings("unchecked")',
+                J.Method('private', 'V', 'value', params=['int index'],
+                    body=[J.Return('(V) container.get(2 * index + 1)')],
+                ),
+                '',
+                # only the keys are converted while looking for one
+                J.Method('private', 'int', 'indexOf', params=['Object key'],
+                    body=[
+                        J.Block(
+                            _start='for (int i = 0; i < size(); i++) {',
+                            body=[J.If('key == null ? key(i) == null : key.equals(key(i))', J.Return('i'))],
+                        ),
+                        J.Return('-1'),
+                    ],
+                ),
+                '',
+                '@Override',
+                J.Method('public', 'boolean', 'containsKey', params=['Object key'],
+                    body=[J.Return('indexOf(key) >= 0')],
+                ),
+                '',
+                '@Override',
+                J.Method('public', 'V', 'get', params=['Object key'],
+                    body=[
+                        'int index = indexOf(key);',
+                        J.Return('index < 0 ? null : value(index)'),
+                    ],
+                ),
+                '',
+                '@Override',
+                J.Method('public', 'Set<Map.Entry<K, V>>', 'entrySet',
+                    body=[J.Return('new EntrySet()')],
+                ),
+                '',
+                # frees the native table, the keys and values that have already been read stay valid
+                '@Override',
+                J.Method('public', 'void', 'close',
+                    body=[J.Call('container.close')],
+                ),
+                '',
+                J.Class(
+                    name='EntrySet',
+                    visibility='private',
+                    extends=['AbstractSet<Map.Entry<K, V>>'],
+                    body=[
+                        '@Override',
+                        J.Method('public', 'int', 'size',
+                            body=[J.Return('NativeMap.this.size()')],
+                        ),
+                        '',
+                        '@Override',
+                        J.Method('public', 'Iterator<Map.Entry<K, V>>', 'iterator',
+                            body=[J.Return('new EntryIterator()')],
+                        ),
+                    ],
+                ),
+                '',
+                J.Class(
+                    name='EntryIterator',
+                    visibility='private',
+                    implements=['Iterator<Map.Entry<K, V>>'],
+                    body=[
+                        'private int index;',
+                        '',
+                        '@Override',
+                        J.Method('public', 'boolean', 'hasNext',
+                            body=[J.Return('index < size()')],
+                        ),
+                        '',
+                        '@Override',
+                        J.Method('public', 'Map.Entry<K, V>', 'next',
+                            body=[
+                                J.If('!hasNext()', 'throw new NoSuchElementException();'),
+                                'Map.Entry<K, V> entry = new AbstractMap.SimpleImmutableEntry<K, V>(key(index), value(index));',
+                                'index++;',
+                                J.Return('entry'),
+                            ],
+                        ),
+                        '',
+                        '@Override',
+                        J.Method('public', 'void', 'remove',
+                            body=['throw new UnsupportedOperationException();'],
+                        ),
+                    ],
+                ),
+            ],
+        )),
+    })
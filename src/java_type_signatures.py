@@ -51,14 +51,51 @@ type_signatures = {
         'hasNext': '()Z',
         'next': '()Ljava/lang/Object;',
     },
+    'Map': {
+        '_path': 'java/util/Map',
+        'entrySet': '()Ljava/util/Set;',
+    },
+    'Map$Entry': {
+        '_path': 'java/util/Map$Entry',
+        'getKey': '()Ljava/lang/Object;',
+        'getValue': '()Ljava/lang/Object;',
+    },
     'IllegalStateException': {
         '_path': 'java/lang/IllegalStateException',
         '_constructor': '(Ljava/lang/String;)V',
     },
+    'IllegalArgumentException': {
+        '_path': 'java/lang/IllegalArgumentException',
+        '_constructor': '(Ljava/lang/String;)V',
+    },
+    'IndexOutOfBoundsException': {
+        '_path': 'java/lang/IndexOutOfBoundsException',
+        '_constructor': '(Ljava/lang/String;)V',
+    },
     'NativeInstance': {
         '_path': PATH_BASE + 'NativeInstance',
         '_constructor': '(L' + PATH_BASE + 'NativePointer' + ';)V',
         'nativeInstance': 'J',
+        '_discard': '()V',
+    },
+    'NativeList': {
+        '_path': PATH_BASE + 'NativeList',
+        '_constructor': '(J)V',
+    },
+    'NativeMap': {
+        '_path': PATH_BASE + 'NativeMap',
+        '_constructor': '(J)V',
+    },
+    'NativeLists': {
+        '_path': PATH_BASE + 'NativeLists',
+        'fromArray': '([Ljava/lang/Object;)Ljava/util/ArrayList;',
+        'fromBooleanArray': '([Z)Ljava/util/ArrayList;',
+        'fromByteArray': '([B)Ljava/util/ArrayList;',
+        'fromShortArray': '([S)Ljava/util/ArrayList;',
+        'fromIntArray': '([I)Ljava/util/ArrayList;',
+        'fromLongArray': '([J)Ljava/util/ArrayList;',
+        'fromFloatArray': '([F)Ljava/util/ArrayList;',
+        'fromDoubleArray': '([D)Ljava/util/ArrayList;',
     },
     'NativePointer': {
         '_path': PATH_BASE + 'NativePointer',
@@ -69,12 +106,17 @@ type_signatures = {
         '_constructor': '()V',
         'getValue': '()I',
     },
+    'Object': {
+        '_path': 'java/lang/Object',
+    },
     'Boolean': {
         '_path': 'java/lang/Boolean',
+        'booleanValue': '()Z',
         'valueOf': '(Z)Ljava/lang/Boolean;',
     },
     'Byte': {
         '_path': 'java/lang/Byte',
+        'byteValue': '()B',
         'valueOf': '(B)Ljava/lang/Byte;',
     },
     'Character': {
@@ -83,14 +125,17 @@ type_signatures = {
     },
     'Short': {
         '_path': 'java/lang/Short',
+        'shortValue': '()S',
         'valueOf': '(S)Ljava/lang/Short;',
     },
     'Integer': {
         '_path': 'java/lang/Integer',
+        'intValue': '()I',
         'valueOf': '(I)Ljava/lang/Integer;',
     },
     'Long': {
         '_path': 'java/lang/Long',
+        'longValue': '()J',
         'valueOf': '(J)Ljava/lang/Long;',
     },
     'Float': {
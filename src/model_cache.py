@@ -0,0 +1,139 @@
+# Copyright (c) 2014-2015, Ericsson AB. All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without modification,
+# are permitted provided that the following conditions are met:
+#
+# 1. Redistributions of source code must retain the above copyright notice, this
+# list of conditions and the following disclaimer.
+#
+# 2. Redistributions in binary form must reproduce the above copyright notice, this
+# list of conditions and the following disclaimer in the documentation and/or other
+# materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS" AND
+# ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE DISCLAIMED.
+# IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT,
+# INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT
+# NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR
+# PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY,
+# WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY
+# OF SUCH DAMAGE.
+
+
+import os
+import sys
+import hashlib
+import tempfile
+import config
+from type_registry import GirMetaType
+
+try:
+    import cPickle as pickle
+except ImportError:
+    import pickle
+
+
+# Bump when the layout of the cached data changes
+CACHE_FORMAT = 1
+
+
+def source_file(module):
+    filename = module.__file__
+    if filename.endswith('.pyc') or filename.endswith('.pyo'):
+        filename = filename[:-1]
+    return filename
+
+
+def file_digest(path):
+    digest = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 16), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def generator_version(modules):
+    # Any edit to the modules that define the model invalidates the cache
+    return hashlib.sha1(''.join(file_digest(source_file(m)) for m in modules)).hexdigest()
+
+
+def is_importable(cls):
+    module = sys.modules.get(cls.__module__)
+    return module is not None and getattr(module, cls.__name__, None) is cls
+
+
+class ModelCache(object):
+    # Meta types created with GirMetaType.__new__ are anonymous classes that
+    # pickle can't find by name, so they are stored by value and recreated
+    # with the same bases and attributes when loading.
+
+    def __init__(self, cache_dir):
+        self.cache_dir = cache_dir
+
+    def key(self, gir_paths, modules, *extra):
+        parts = [
+            str(CACHE_FORMAT),
+            generator_version(modules),
+            repr(config.PACKAGE_ROOT),
+            repr(config.IGNORED_ELEMENTS),
+            repr(config.LAZY_CONTAINER_FUNCTIONS),
+        ] + map(repr, extra) + map(file_digest, gir_paths)
+        return hashlib.sha1('\n'.join(parts)).hexdigest()
+
+    def path(self, key):
+        return os.path.join(self.cache_dir, key + '.pickle')
+
+    def load(self, key):
+        path = self.path(key)
+        if not os.path.isfile(path):
+            return None
+
+        loaded = {}
+
+        def persistent_load(pid):
+            if len(pid) == 2:
+                return loaded[pid[1]]
+            _, index, name, bases, attrs = pid
+            attrs['__new__'] = object.__new__
+            cls = type(name, bases, attrs)
+            loaded[index] = cls
+            return cls
+
+        try:
+            with open(path, 'rb') as f:
+                unpickler = pickle.Unpickler(f)
+                unpickler.persistent_load = persistent_load
+                return unpickler.load()
+        except Exception as e:
+            print('ignoring unreadable model cache "{}": {}'.format(path, e))
+            return None
+
+    def store(self, key, value):
+        saved = {}
+
+        def persistent_id(obj):
+            if not isinstance(obj, type) or not issubclass(obj, GirMetaType) or is_importable(obj):
+                return None
+            index = saved.get(id(obj))
+            if index is not None:
+                return ('metatype', index)
+            index = saved[id(obj)] = len(saved)
+            attrs = dict((k, v) for k, v in obj.__dict__.items() if k != '__new__')
+            return ('metatype', index, obj.__name__, obj.__bases__, attrs)
+
+        if not os.path.isdir(self.cache_dir):
+            os.makedirs(self.cache_dir)
+
+        # Write to a temporary file first so that readers never see a partial entry
+        fd, tmp_path = tempfile.mkstemp(dir=self.cache_dir, suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                pickler = pickle.Pickler(f, pickle.HIGHEST_PROTOCOL)
+                pickler.persistent_id = persistent_id
+                pickler.dump(value)
+            os.rename(tmp_path, self.path(key))
+        except:
+            os.remove(tmp_path)
+            raise
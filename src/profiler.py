@@ -0,0 +1,118 @@
+# Copyright (c) 2014-2015, Ericsson AB. All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without modification,
+# are permitted provided that the following conditions are met:
+#
+# 1. Redistributions of source code must retain the above copyright notice, this
+# list of conditions and the following disclaimer.
+#
+# 2. Redistributions in binary form must reproduce the above copyright notice, this
+# list of conditions and the following disclaimer in the documentation and/or other
+# materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS" AND
+# ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE DISCLAIMED.
+# IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT,
+# INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT
+# NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR
+# PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY,
+# WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY
+# OF SUCH DAMAGE.
+
+
+
+import json
+import time
+import resource
+from collections import OrderedDict
+from contextlib import contextmanager
+
+
+def peak_memory(who=resource.RUSAGE_SELF):
+    # kilobytes on linux
+    return resource.getrusage(who).ru_maxrss
+
+
+# Phases with the same name are accumulated. Phases may nest, e.g. the time
+# spent in 'write' is also part of the phase that rendered the output.
+class Profiler(object):
+    def __init__(self):
+        self.enabled = False
+        self.start_time = time.time()
+        self.phases = OrderedDict()
+        self.counts = OrderedDict()
+
+    # ru_maxrss only ever grows over the lifetime of the process, so a phase records
+    # how much it raised the peak, not the peak itself
+    def add_time(self, name, wall_time, calls=1, memory_growth=0):
+        phase = self.phases.setdefault(name, {'wall_time': 0.0, 'calls': 0, 'peak_memory_growth_kb': 0})
+        phase['wall_time'] += wall_time
+        phase['calls'] += calls
+        phase['peak_memory_growth_kb'] += memory_growth
+
+    @contextmanager
+    def phase(self, name):
+        if not self.enabled:
+            yield
+            return
+        start = time.time()
+        start_memory = peak_memory()
+        try:
+            yield
+        finally:
+            self.add_time(name, time.time() - start, memory_growth=peak_memory() - start_memory)
+
+    def merge(self, phases):
+        for name, phase in phases.items():
+            self.add_time(name, phase['wall_time'], phase['calls'], phase['peak_memory_growth_kb'])
+
+    def count(self, name, n=1):
+        self.counts[name] = self.counts.get(name, 0) + n
+
+    def count_model(self, namespaces, type_registry):
+        for namespace in namespaces:
+            self.count('namespaces')
+            self.count('classes', len(namespace.classes))
+            self.count('interfaces', len(namespace.interfaces))
+            self.count('enums', len(namespace.enums))
+            self.count('callbacks', len(namespace.callbacks))
+            self.count('functions', len(namespace.functions))
+            for clazz in namespace.classes + namespace.interfaces:
+                self.count('constructors', len(clazz.constructors))
+                self.count('methods', len(clazz.methods) + len(clazz.functions))
+                self.count('signals', len(clazz.signals))
+                self.count('properties', len(clazz.properties))
+
+        stats = type_registry.lookup_stats()
+        self.count('lookups', stats['lookups'])
+        self.count('lookup_hits', stats['hits'])
+        self.count('lookup_misses', stats['misses'])
+
+    def report(self):
+        return OrderedDict([
+            ('wall_time', time.time() - self.start_time),
+            ('peak_memory_kb', peak_memory()),
+            ('children_peak_memory_kb', peak_memory(resource.RUSAGE_CHILDREN)),
+            ('phases', self.phases),
+            ('counts', self.counts),
+        ])
+
+    def write(self, path):
+        with open(path, 'w') as f:
+            json.dump(self.report(), f, indent=4)
+
+
+profiler = Profiler()
+
+
+def run_profiled(func, *args):
+    # Runs func with an empty set of phases and returns them along with the
+    # result, so that pool workers can send their phases back to be merged
+    phases = profiler.phases
+    profiler.phases = OrderedDict()
+    try:
+        return func(*args), profiler.phases
+    finally:
+        profiler.phases = phases
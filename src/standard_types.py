@@ -22,7 +22,9 @@
 # OF SUCH DAMAGE.
 
 
+import re
 import config
+from copy import copy
 from type_registry import GirMetaType
 from type_registry import TypeTransform
 from c_generator import C
@@ -31,12 +33,10 @@ from c_generator import C
 C.Helper.add_helper('jobject_wrapper_create',
     C.Function('jobject_wrapper_create',
         return_type='JObjectWrapper*',
-        params=['jobject jobj', 'gboolean weak'],
+        params=['JNIEnv* env', 'jobject jobj', 'gboolean weak'],
         body=[
-            C.Decl('JNIEnv*', 'env'),
             C.Decl('JObjectWrapper*', 'wrapper'),
             '',
-            C.Assign('env', C.Call('get_jni_env')),
             C.Assign('wrapper', C.Call('g_slice_new0', 'JObjectWrapper')),
             C.Assert('wrapper'),
             C.IfElse(ifs=['weak'],
@@ -58,12 +58,10 @@ C.Helper.add_helper('jobject_wrapper_create',
 C.Helper.add_helper('jobject_wrapper_destroy',
     C.Function('jobject_wrapper_destroy',
         return_type='void',
-        params=['gpointer data_pointer', 'gboolean weak'],
+        params=['JNIEnv* env', 'gpointer data_pointer', 'gboolean weak'],
         body=[
-            C.Decl('JNIEnv*', 'env'),
             C.Decl('JObjectWrapper*', 'wrapper'),
             '',
-            C.Assign('env', C.Call('get_jni_env')),
             C.Assign('wrapper', 'data_pointer', cast='JObjectWrapper*'),
             C.Assert('wrapper'),
             '',
@@ -86,13 +84,13 @@ C.Helper.add_helper('jobject_wrapper_destroy',
 C.Helper.add_helper('jobject_callback_wrapper_create',
     C.Function('jobject_callback_wrapper_create',
         return_type='JObjectCallbackWrapper*',
-        params=['jobject jobj', 'gboolean should_destroy'],
+        params=['JNIEnv* env', 'jobject jobj', 'gboolean should_destroy'],
         body=[
             C.Decl('JObjectCallbackWrapper*', 'callback_wrapper'),
             '',
             C.Assign('callback_wrapper', C.Call('g_slice_new0', 'JObjectCallbackWrapper')),
             C.Assert('callback_wrapper'),
-            C.Assign('callback_wrapper->wrapper', C.Helper('jobject_wrapper_create', 'jobj', 'FALSE')),
+            C.Assign('callback_wrapper->wrapper', C.Helper('jobject_wrapper_create', 'env', 'jobj', 'FALSE')),
             C.Assign('callback_wrapper->should_destroy', 'should_destroy'),
             '',
             C.Return('callback_wrapper'),
@@ -100,27 +98,89 @@ C.Helper.add_helper('jobject_callback_wrapper_create',
     )
 )
 
-C.Helper.add_helper('jobject_callback_wrapper_destroy',
-    C.Function('jobject_callback_wrapper_destroy',
+C.Helper.add_helper('jobject_callback_wrapper_free',
+    C.Function('jobject_callback_wrapper_free',
         return_type='void',
-        params=['gpointer user_data'],
+        params=['JNIEnv* env', 'gpointer user_data'],
         body=[
             C.Decl('JObjectCallbackWrapper*', 'callback_wrapper'),
             '',
             C.Assign('callback_wrapper', 'user_data', cast='JObjectCallbackWrapper*'),
-            C.Helper('jobject_wrapper_destroy', 'callback_wrapper->wrapper', 'FALSE'),
+            C.Helper('jobject_wrapper_destroy', 'env', 'callback_wrapper->wrapper', 'FALSE'),
             C.Call('g_slice_free', 'JObjectCallbackWrapper', 'callback_wrapper'),
         ]
     )
 )
 
+# GDestroyNotify, called from arbitrary threads without an env at hand
+C.Helper.add_helper('jobject_callback_wrapper_destroy',
+    C.Function('jobject_callback_wrapper_destroy',
+        return_type='void',
+        params=['gpointer user_data'],
+        body=[
+            C.Helper('jobject_callback_wrapper_free', C.Call('get_jni_env'), 'user_data'),
+        ]
+    )
+)
+
 C.Helper.add_helper('jobject_wrapper_closure_notify',
     C.Function('jobject_wrapper_closure_notify',
         return_type='void',
         params=['gpointer data_pointer', 'GClosure* ignored'],
         body=[
             C.Decl('(void)', 'ignored'),
-            C.Helper('jobject_wrapper_destroy', 'data_pointer', 'FALSE'),
+            C.Helper('jobject_wrapper_destroy', C.Call('get_jni_env'), 'data_pointer', 'FALSE'),
+        ]
+    )
+)
+
+# Copies a string into buf if it fits, or into a new buffer that the caller frees
+C.Helper.add_helper('jstring_to_utf8',
+    C.Function('jstring_to_utf8',
+        return_type='gchar*',
+        params=['JNIEnv* env', 'jstring str', 'gchar* buf', 'gsize buf_size'],
+        body=[
+            C.Decl('jsize', 'length'),
+            C.Decl('jsize', 'utf_length'),
+            C.Decl('gchar*', 'chars'),
+            '',
+            C.Assign('length', C.Env('GetStringLength', 'str')),
+            C.Assign('utf_length', C.Env('GetStringUTFLength', 'str')),
+            C.Assign('chars', '(gsize) utf_length < buf_size ? buf : g_malloc(utf_length + 1)'),
+            C.Env('GetStringUTFRegion', 'str', '0', 'length', 'chars'),
+            C.If(C.Env('ExceptionCheck'), [
+                C.If('chars != buf', C.Call('g_free', 'chars')),
+                C.Return('NULL'),
+            ]),
+            C.Assign('chars[utf_length]', "'\\0'"),
+            C.Return('chars'),
+        ]
+    )
+)
+
+C.Helper.add_helper('java_class_for_type',
+    C.Function('java_class_for_type',
+        return_type='jclass',
+        params=['GType type'],
+        body=[
+            C.Decl('GType', 'parent'),
+            C.Decl('jclass', 'clazz'),
+            '',
+            C.Assign('clazz', C.Call('g_type_get_qdata', 'type', 'java_class_quark'), cast='jclass'),
+            C.If(C.Call('G_LIKELY', 'clazz'), C.Return('clazz')),
+            '',
+            # unbound subclasses are wrapped as their closest bound ancestor
+            C.Block(
+                _start='for (parent = type; parent; parent = g_type_parent(parent)) {',
+                body=[
+                    C.Assign('clazz', C.Call('java_class_from_type_name', C.Call('g_type_name', 'parent'))),
+                    C.If('clazz', [
+                        C.Call('g_type_set_qdata', 'type', 'java_class_quark', 'clazz'),
+                        C.Return('clazz'),
+                    ]),
+                ],
+            ),
+            C.Return('NULL'),
         ]
     )
 )
@@ -138,7 +198,7 @@ C.Helper.add_helper('gobject_to_jobject',
                 C.Return('NULL')),
             C.Assign('gobj', C.Call('G_OBJECT', 'data_pointer')),
             '',
-            C.Assign('wrapper', C.Call('g_object_get_data', 'gobj', '"java_instance"'), cast='JObjectWrapper*'),
+            C.Assign('wrapper', C.Call('g_object_get_qdata', 'gobj', 'java_instance_quark'), cast='JObjectWrapper*'),
             C.IfElse(ifs=['wrapper'],
                 bodies=[[
                     C.Log.verbose('got jobject[%p] from gobject[%p]', 'wrapper->obj', 'gobj'),
@@ -149,7 +209,7 @@ C.Helper.add_helper('gobject_to_jobject',
                     C.Decl('jobject', 'native_pointer'),
                     C.Decl('GWeakRef*', 'ref'),
                     '',
-                    C.Assign('clazz', C.Call('g_hash_table_lookup', 'gobject_to_java_class_map', C.Call('G_OBJECT_TYPE', 'gobj'))),
+                    C.Assign('clazz', C.Helper('java_class_for_type', C.Call('G_OBJECT_TYPE', 'gobj'))),
                     C.If('!clazz', [
                         C.Log.error('Java class not found for GObject type: %s', C.Call('G_OBJECT_TYPE_NAME', 'gobj')),
                         C.Return('NULL'),
@@ -164,11 +224,22 @@ C.Helper.add_helper('gobject_to_jobject',
                     C.ExceptionCheck('NULL'),
                     '',
                     C.Assign('jobj', C.Env('NewObject', 'clazz', C.Cache.method('NativeInstance', '_constructor'), 'native_pointer')),
+                    C.Env('DeleteLocalRef', 'native_pointer'),
                     C.ExceptionCheck('NULL'),
                     '',
-                    C.Assign('wrapper', C.Helper('jobject_wrapper_create', 'jobj', 'TRUE')),
+                    C.Assign('wrapper', C.Helper('jobject_wrapper_create', 'env', 'jobj', 'TRUE')),
                     C.Assert('wrapper'),
-                    C.Call('g_object_set_data', 'gobj', '"java_instance"', 'wrapper'),
+                    C.If('!g_object_replace_qdata(gobj, java_instance_quark, NULL, wrapper, NULL, NULL)', [
+                        C.Comment('another thread wrapped the object first, undo and use its wrapper'),
+                        C.Helper('jobject_wrapper_destroy', 'env', 'wrapper', 'TRUE'),
+                        C.Env.method('jobj', ('NativeInstance', '_discard')),
+                        C.Env('DeleteLocalRef', 'jobj'),
+                        C.Call('g_weak_ref_clear', 'ref'),
+                        C.Call('g_free', 'ref'),
+                        C.If('take_ref', C.Call('g_object_unref', 'gobj')),
+                        C.Assign('wrapper', C.Call('g_object_get_qdata', 'gobj', 'java_instance_quark'), cast='JObjectWrapper*'),
+                        C.Return('wrapper->obj'),
+                    ]),
                     '',
                     C.Log.verbose('got jobject[%p] from GObject[%p]', 'jobj', 'gobj'),
                     C.Return('jobj'),
@@ -190,6 +261,10 @@ C.Helper.add_helper('jobject_to_gobject',
                 C.Return('NULL')),
             '',
             C.Assign('ref', C.Env.field('jobj', ('NativeInstance', 'nativeInstance')), cast='GWeakRef*'),
+            C.If('!ref', [
+                C.Env.throw('IllegalStateException', '"native instance has been closed"'),
+                C.Return('NULL'),
+            ]),
             C.Assign('gobj', C.Call('g_weak_ref_get', 'ref')),
             C.If('!gobj',
                 C.Env.throw('IllegalStateException', '"GObject ref was NULL at translation"')),
@@ -242,6 +317,25 @@ C.Helper.add_helper('gvalue_to_jobject',
     )
 )
 
+# Releases a NativeContainer together with the items and the container it holds on to
+C.Helper.add_helper('native_container_free',
+    C.Function('native_container_free',
+        return_type='void',
+        params=['NativeContainer* container'],
+        body=[
+            C.Decl('jsize', 'i'),
+            '',
+            C.If('container->free_item', C.Block(
+                _start='for (i = 0; i < container->length; i++) {',
+                body=[C.Call('container->free_item', 'container->items[i]')],
+            )),
+            C.If('container->free_container', C.Call('container->free_container', 'container->container')),
+            C.Call('g_free', 'container->items'),
+            C.Call('g_free', 'container'),
+        ]
+    )
+)
+
 
 class PrimitiveMetaType(GirMetaType):
     default_value = '0'
@@ -312,21 +406,58 @@ class PrimitiveArrayMetaType(GirMetaType):
             typ.object_type,
         )
 
+    @property
+    def element_size_assert(self):
+        return 'G_STATIC_ASSERT(sizeof(%s) == sizeof(%s));' % (self.c_element_type, self.jni_type[:-5])
+
+    @property
+    def is_critical(self):
+        # nothing after the array may call into the VM until it is released again
+        if getattr(self, 'function_name', None) not in config.CRITICAL_ARRAY_FUNCTIONS:
+            return False
+        params = list(self.parent)
+        following = params[params.index(self) + 1:]
+        return all(isinstance(param, PrimitiveMetaType) for param in following)
+
     def transform_to_c(self):
         assert not self.transfer_ownership # transfer not implemented
-        return TypeTransform([
+        declarations = [
             C.Decl(self.c_type, self.c_name),
             C.Decl('jsize', self.length.jni_name),
             C.Decl(self.length.c_type, self.length.c_name),
-        ], [
-            C.Assert('sizeof(%s) == sizeof(%s)' % (self.c_element_type, self.jni_type[:-5])),
-            C.Assign(self.c_name, C.Env('Get%sArrayElements' % self.primitive_type_name, self.jni_name, 'NULL'), cast=self.c_type),
+        ]
+        get_length = [
+            C.Assign(self.length.jni_name, C.Env('GetArrayLength', '(jarray) ' + self.jni_name)),
             C.ExceptionCheck.default(self),
-            C.Assign(self.length.c_name, C.Env('GetArrayLength', '(jarray) ' + self.jni_name), cast=self.length.c_type),
+            C.Assign(self.length.c_name, self.length.jni_name, cast=self.length.c_type),
+        ]
+
+        if self.is_critical:
+            return TypeTransform(declarations + [self.element_size_assert], get_length + [
+                C.Assign(self.c_name, C.Env('GetPrimitiveArrayCritical', '(jarray) ' + self.jni_name, 'NULL'), cast=self.c_type),
+                C.If('!' + self.c_name, C.Return(self.parent.return_value.default_value)),
+            ], [
+                # discard any changes
+                C.Env('ReleasePrimitiveArrayCritical', '(jarray) ' + self.jni_name, self.c_name, 'JNI_ABORT'),
+            ])
+
+        # short arrays are copied to the stack, longer ones are left to the VM
+        buf = self.c_name + '_buf'
+        return TypeTransform(declarations + [
+            C.Decl(self.jni_type[:-5], '%s[%d / sizeof(%s)]' % (buf, config.ARRAY_BUFFER_SIZE, self.jni_type[:-5])),
+            self.element_size_assert,
+        ], get_length + [
+            C.IfElse(ifs=['%s <= (jsize) G_N_ELEMENTS(%s)' % (self.length.jni_name, buf)], bodies=[[
+                C.Env('Get%sArrayRegion' % self.primitive_type_name, self.jni_name, '0', self.length.jni_name, buf),
+                C.Assign(self.c_name, buf, cast=self.c_type),
+            ],[
+                C.Assign(self.c_name, C.Env('Get%sArrayElements' % self.primitive_type_name, self.jni_name, 'NULL'), cast=self.c_type),
+            ]]),
             C.ExceptionCheck.default(self),
         ], [
             # discard any changes
-            C.Env('Release%sArrayElements' % self.primitive_type_name, self.jni_name, self.c_name, 'JNI_ABORT'),
+            C.If('(gpointer) %s != (gpointer) %s' % (self.c_name, buf),
+                C.Env('Release%sArrayElements' % self.primitive_type_name, self.jni_name, self.c_name, 'JNI_ABORT')),
             C.ExceptionCheck.default(self),
         ])
 
@@ -334,8 +465,8 @@ class PrimitiveArrayMetaType(GirMetaType):
         return TypeTransform([
             C.Decl(self.jni_type, self.jni_name),
             C.Decl('jsize', self.length.jni_name),
+            self.element_size_assert,
         ], [
-            C.Assert('sizeof(%s) == sizeof(%s)' % (self.c_element_type, self.jni_type[:-5])),
             C.Assign(self.length.jni_name, self.length.c_name, cast='jsize'),
             C.Assign(self.jni_name, C.Env('New%sArray' % self.primitive_type_name, self.length.jni_name)),
             C.ExceptionCheck.default(self),
@@ -522,9 +653,9 @@ class JObjectWrapperType(ObjectMetaType(
     def transform_to_c(self):
         create = None
         if self.scope is None:
-            create = C.Helper('jobject_wrapper_create', self.closure.jni_name, 'FALSE')
+            create = C.Helper('jobject_wrapper_create', 'env', self.closure.jni_name, 'FALSE')
         else:
-            create = C.Helper('jobject_callback_wrapper_create', self.closure.jni_name,
+            create = C.Helper('jobject_callback_wrapper_create', 'env', self.closure.jni_name,
                 'TRUE' if self.scope == 'async' else 'FALSE')
 
         return TypeTransform([
@@ -532,7 +663,7 @@ class JObjectWrapperType(ObjectMetaType(
         ],[
             C.Assign(self.c_name, create),
         ], self.scope == 'call' and [
-            C.Helper('jobject_callback_wrapper_destroy', self.c_name),
+            C.Helper('jobject_callback_wrapper_free', 'env', self.c_name),
         ])
 
     def transform_to_jni(self):
@@ -548,7 +679,7 @@ class JObjectWrapperType(ObjectMetaType(
             C.Assign(self.jni_name, get),
         ], self.transfer_ownership and [
             C.If('((JObjectCallbackWrapper *) %s)->should_destroy' % self.c_name,
-                C.Helper('jobject_callback_wrapper_destroy', self.c_name),
+                C.Helper('jobject_callback_wrapper_free', 'env', self.c_name),
             ),
         ])
 
@@ -577,6 +708,7 @@ class EnumMetaType(ObjectMetaType):
             C.Decl(self.jni_type, self.jni_name),
         ],[
             C.Assign(self.jni_name, C.Helper(self.gir_type + '_to_java_enum', 'env', self.c_name)),
+            C.ExceptionCheck.default(self),
         ])
 
 
@@ -597,6 +729,53 @@ class JDestroyType(ObjectMetaType(
         ])
 
 
+# A direct java.nio.ByteBuffer passed in place of a byte array, together with an
+# offset into it and the length of the array, see BaseFunction.direct_buffer_variant
+class DirectBufferType(ObjectMetaType(
+        gir_type=None,
+        java_type='ByteBuffer',
+        c_type='gpointer',
+        package='java.nio',
+    )):
+    has_local_ref = False
+
+    def __init__(self, array, offset):
+        super(DirectBufferType, self).__init__(array.name, transfer_ownership=False, allow_none=False)
+        self.c_type = array.c_type
+        self.length = array.length
+        self.offset = offset
+
+    def transform_to_c(self):
+        address = self.c_name + '_address'
+        capacity = self.c_name + '_capacity'
+        return TypeTransform([
+            C.Decl(self.c_type, self.c_name),
+            C.Decl(self.length.c_type, self.length.c_name),
+            C.Decl('guint8*', address),
+            C.Decl('jlong', capacity),
+        ],[
+            C.Assign(address, C.Env('GetDirectBufferAddress', self.jni_name), cast='guint8*'),
+            C.If('!' + address, [
+                C.Env.throw('IllegalArgumentException', '"buffer is not direct"'),
+                C.Return(self.parent.return_value.default_value),
+            ]),
+            # checked again here, the native method can be reached without the Java overload
+            C.Assign(capacity, C.Env('GetDirectBufferCapacity', self.jni_name)),
+            C.If('{0} < 0 || {1} < 0 || {1} > {2} - {0}'.format(self.offset.jni_name, self.length.jni_name, capacity), [
+                C.Env.throw('IndexOutOfBoundsException', '"buffer range out of bounds"'),
+                C.Return(self.parent.return_value.default_value),
+            ]),
+            C.Assign(self.c_name, '(%s + %s)' % (address, self.offset.jni_name), cast=self.c_type),
+            C.Assign(self.length.c_name, self.length.jni_name, cast=self.length.c_type),
+        ])
+
+
+class BufferOffsetType(PrimitiveMetaType('int', 'jint', None, 'I', 'Integer')):
+    # applied by the DirectBufferType, never passed on to C
+    def transform_to_c(self):
+        return TypeTransform()
+
+
 class CallbackMetaType(ObjectMetaType):
     def __init__(self, name, transfer_ownership=False, allow_none=False, scope=None):
         super(CallbackMetaType, self).__init__(name, transfer_ownership, allow_none)
@@ -672,36 +851,26 @@ class StringMetaType(ObjectMetaType):
         )
 
     def transform_to_c(self):
-        if self.transfer_ownership:
-            tmp = self.c_name + '_tmp'
-            return TypeTransform([
-                C.Decl(self.c_type, self.c_name),
-                C.Decl(self.c_type, tmp),
-            ],[
-                C.IfElse(ifs=[self.jni_name], bodies=[[
-                    C.Assign(tmp, C.Env('GetStringUTFChars', self.jni_name, 'NULL'), cast=self.c_type),
-                    C.ExceptionCheck.default(self),
-                    C.Assign(self.c_name, C.Call('g_strdup', tmp)),
-                ],[
-                    C.Assign(self.c_name, 'NULL'),
-                ]])
-            ],[
-                C.If(self.jni_name, C.Env('ReleaseStringUTFChars', self.jni_name, tmp)),
-            ])
-        else:
-            return TypeTransform([
-                C.Decl(self.c_type, self.c_name),
-            ],[
+        # Parameters that stay with the caller are copied to the stack when they fit,
+        # anything else, including the items of containers, gets a g_malloc'ed copy
+        parent = getattr(self, 'parent', None)
+        on_stack = not self.transfer_ownership and parent is not None and any(param is self for param in parent)
+        buf = self.c_name + '_buf'
+        return TypeTransform([
+            C.Decl(self.c_type, self.c_name),
+            C.Decl('gchar', '%s[%d]' % (buf, config.STRING_BUFFER_SIZE)) if on_stack else [],
+        ],[
             C.IfElse(ifs=[self.jni_name], bodies=[[
-                    C.Assign(self.c_name, C.Env('GetStringUTFChars', self.jni_name, 'NULL'), cast=self.c_type),
-                    C.ExceptionCheck.default(self),
-                ],[
-                    C.Assign(self.c_name, 'NULL'),
-                ]]),
+                C.Assign(self.c_name, C.Helper('jstring_to_utf8', 'env', self.jni_name,
+                    buf if on_stack else 'NULL', 'sizeof(%s)' % buf if on_stack else '0'), cast=self.c_type),
+                C.ExceptionCheck.default(self),
             ],[
-                C.If(self.jni_name, C.Env('ReleaseStringUTFChars', self.jni_name, self.c_name)),
-            ])
-
+                C.Assign(self.c_name, 'NULL'),
+            ]]),
+        ], not self.transfer_ownership and [
+            C.If('%s != %s' % (self.c_name, buf), C.Call('g_free', '(gpointer) ' + self.c_name)) if on_stack
+                else C.Call('g_free', '(gpointer) ' + self.c_name),
+        ])
 
     def transform_to_jni(self):
         return TypeTransform([
@@ -761,6 +930,101 @@ class ContainerMetaType(ObjectMetaType):
             sum([transform.cleanup for transform in reversed(inner_transforms)], []),
         )
 
+    def list_transform_to_jni(self, length_func):
+        # The elements are collected in a presized array, which is turned into a list
+        # with a single call into the VM instead of one call per element
+        value = self.inner_value
+        if isinstance(value, PrimitiveMetaType):
+            # numbers are copied to a primitive array in one go, and boxed on the Java side
+            numbers = NumericListArrayType(self)
+            numbers.parent = self.parent
+            numbers.transfer_ownership = False
+            numbers.jni_name = self.jni_name + '_array'
+            transform = numbers.transform_to_jni()
+            return TypeTransform([
+                C.Decl(self.jni_type, self.jni_name),
+                transform.declarations,
+            ],[
+                transform.conversion,
+                C.Assign(self.jni_name, C.Env.static_method(('NativeLists', 'from%sArray' % numbers.primitive_type_name), numbers.jni_name)),
+                C.ExceptionCheck.default(self),
+                C.Env('DeleteLocalRef', numbers.jni_name),
+            ])
+
+        it = self.c_name + '_it'
+        array = self.jni_name + '_array'
+        length = self.jni_name + '_length'
+        index = self.jni_name + '_index'
+        inner_transforms = ContainerMetaType.transform_to_jni(self)
+        return TypeTransform([
+            C.Decl(self.jni_type, self.jni_name),
+            C.Decl('jobjectArray', array),
+            C.Decl('jsize', length),
+            C.Decl('jsize', index),
+            C.Decl(self.c_type, it),
+            C.Decl(value.c_type, value.c_name),
+            inner_transforms.declarations,
+        ],[
+            C.Assign(length, C.Call(length_func, self.c_name), cast='jsize'),
+            C.Assign(array, C.Env('NewObjectArray', length, C.Cache('Object'), 'NULL')),
+            C.ExceptionCheck.default(self),
+            C.Assign(index, '0'),
+            C.Assign(it, self.c_name),
+            C.While(it,
+                C.Assign(value.c_name, it + '->data'),
+                inner_transforms.conversion,
+                C.ExceptionCheck.default(self),
+                C.Env('SetObjectArrayElement', array, index, value.jni_name),
+                C.ExceptionCheck.default(self),
+                C.Env('DeleteLocalRef', value.jni_name) if value.has_local_ref else [],
+                inner_transforms.cleanup,
+                C.Assign(index, '1', op='+='),
+                C.Assign(it, it + '->next'),
+            ),
+            C.Assign(self.jni_name, C.Env.static_method(('NativeLists', 'fromArray'), array)),
+            C.ExceptionCheck.default(self),
+            C.Env('DeleteLocalRef', array),
+        ])
+
+    def list_transform_to_c(self, prefix):
+        # The items are prepended while iterating, and the list is reversed once at the end
+        value = self.inner_value
+        if not is_native_container_item(value):
+            return TypeTransform([]) # FIXME: not implemented
+        it = self.jni_name + '_iterator'
+        items = self.c_name + '_items'
+        free_item = container_item_free(value)
+        # with transfer container the callee only frees the list, the items are freed from a copy
+        copy_items = self.transfer_ownership and not value.transfer_ownership and free_item
+        item_transform = container_item_transform_to_c(self, value)
+        return TypeTransform([
+            C.Decl(self.c_type, self.c_name),
+            C.Decl(self.c_type, items) if copy_items else [],
+            C.Decl('jobject', it),
+            item_transform.declarations,
+        ],[
+            C.Assign(self.c_name, 'NULL'),
+            C.If(self.jni_name, [
+                C.Assign(it, C.Env.method(self.jni_name, ('Iterable', 'iterator'))),
+                C.ExceptionCheck.default(self),
+                C.While(C.Env.method(it, ('Iterator', 'hasNext')),
+                    C.Assign(value.jni_name, C.Env.method(it, ('Iterator', 'next'))),
+                    C.ExceptionCheck.default(self),
+                    item_transform.conversion,
+                    C.Env('DeleteLocalRef', value.jni_name),
+                    C.Assign(self.c_name, C.Call(prefix + '_prepend', self.c_name, container_item_pointer(value))),
+                ),
+                C.Env('DeleteLocalRef', it),
+                C.Assign(self.c_name, C.Call(prefix + '_reverse', self.c_name)),
+            ]),
+            C.Assign(items, C.Call(prefix + '_copy', self.c_name)) if copy_items else [],
+        ], copy_items and [
+            C.Call(prefix + '_free_full', items, '(GDestroyNotify) ' + free_item),
+        ] or not self.transfer_ownership and [
+            C.Call(prefix + '_free_full', self.c_name, '(GDestroyNotify) ' + free_item) if free_item
+                else C.Call(prefix + '_free', self.c_name),
+        ])
+
 
 class BitfieldMetaType(ContainerMetaType):
     is_container = False
@@ -807,12 +1071,24 @@ class BitfieldMetaType(ContainerMetaType):
             C.While(self.c_name,
                 C.Assign(enum.c_name, "{0} & -{0}".format(self.c_name)),
                 C.Assign(enum.jni_name, C.Helper(self.gir_type + '_to_java_enum', 'env', enum.c_name)),
+                C.ExceptionCheck.default(self),
                 C.Env.method(self.jni_name, ('EnumSet', 'add'), enum.jni_name),
                 C.Assign(self.c_name, "{0} & ({0} - 1)".format(self.c_name)),
             )
         ])
 
 
+# A bitfield passed as an int mask, the Java wrapper of the function converts it
+# from and to an EnumSet, see BaseFunction.bitfield_mask_variant
+class BitfieldMaskType(PrimitiveMetaType('int', 'jint', None, 'I', 'Integer')):
+    def __init__(self, bitfield):
+        super(BitfieldMaskType, self).__init__(bitfield.name, bitfield.transfer_ownership)
+        self.c_type = bitfield.c_type
+        self.gir_type = bitfield.gir_type
+        self.enum_full_class = bitfield.inner_value.java_full_class
+        self.doc = getattr(bitfield, 'doc', None)
+
+
 class GListType(ContainerMetaType(
         gir_type='GLib.List',
         java_type='List',
@@ -824,29 +1100,10 @@ class GListType(ContainerMetaType(
         (self.inner_value,) = self.inner_values
 
     def transform_to_c(self):
-        return TypeTransform([]) # FIXME: not implemented
+        return self.list_transform_to_c('g_list')
 
     def transform_to_jni(self):
-        it = self.c_name + '_it'
-        inner_transforms = super(GListType, self).transform_to_jni()
-        return TypeTransform([
-            C.Decl(self.jni_type, self.jni_name),
-            C.Decl(self.c_type, it),
-            C.Decl(self.inner_value.c_type, self.inner_value.c_name),
-            inner_transforms.declarations,
-        ],[
-            C.Assign(self.jni_name, C.Env.new('ArrayList')),
-            C.Assign(it, self.c_name),
-            C.While(it,
-                C.Assign(self.inner_value.c_name, it + '->data'),
-                inner_transforms.conversion,
-                C.Env.method(self.jni_name, ('ArrayList', 'add'), self.inner_value.jni_name),
-                C.ExceptionCheck.default(self),
-                C.Env('DeleteLocalRef', self.inner_value.jni_name) if self.inner_value.has_local_ref else [],
-                inner_transforms.cleanup,
-                C.Assign(it, it + '->next'),
-            ),
-        ])
+        return self.list_transform_to_jni('g_list_length')
 
 
 class GSListType(ContainerMetaType(
@@ -860,28 +1117,60 @@ class GSListType(ContainerMetaType(
         (self.inner_value,) = self.inner_values
 
     def transform_to_c(self):
-        return TypeTransform([]) # FIXME: not implemented
+        return self.list_transform_to_c('g_slist')
+
+    def transform_to_jni(self):
+        return self.list_transform_to_jni('g_slist_length')
+
+
+# A GList or GSList of numbers returned as a primitive array, see BaseFunction.numeric_array_variant
+class NumericListArrayType(GirMetaType()):
+    default_value = 'NULL'
+    has_local_ref = True
+
+    def __init__(self, container):
+        super(NumericListArrayType, self).__init__(container.name, container.transfer_ownership, container.allow_none)
+        self.inner_value = container.inner_value
+        self.c_type = container.c_type
+        self.java_type = self.inner_value.java_type + '[]'
+        self.jni_type = self.inner_value.jni_type + 'Array'
+        self.java_signature = '[' + self.inner_value.java_signature
+        self.primitive_type_name = self.inner_value.java_type.title()
+        self.list_prefix = 'g_slist' if container.c_type.startswith('GSList') else 'g_list'
 
     def transform_to_jni(self):
         it = self.c_name + '_it'
-        inner_transforms = super(GSListType, self).transform_to_jni()
+        length = self.jni_name + '_length'
+        index = self.jni_name + '_index'
+        buf = self.jni_name + '_buf'
+        elements = self.jni_name + '_elements'
+        element_type = self.inner_value.jni_type
+        if element_type == 'jint':
+            element = '(jint) GPOINTER_TO_INT(%s->data)' % it
+        else:
+            element = '(%s) (gintptr) %s->data' % (element_type, it)
         return TypeTransform([
             C.Decl(self.jni_type, self.jni_name),
             C.Decl(self.c_type, it),
-            C.Decl(self.inner_value.c_type, self.inner_value.c_name),
-            inner_transforms.declarations,
+            C.Decl('jsize', length),
+            C.Decl('jsize', index),
+            C.Decl(element_type, '%s[%d / sizeof(%s)]' % (buf, config.ARRAY_BUFFER_SIZE, element_type)),
+            C.Decl(element_type + '*', elements),
         ],[
-            C.Assign(self.jni_name, C.Env.new('ArrayList')),
-            C.Assign(it, self.c_name),
-            C.While(it,
-                C.Assign(self.inner_value.c_name, it + '->data'),
-                inner_transforms.conversion,
-                C.Env.method(self.jni_name, ('ArrayList', 'add'), self.inner_value.jni_name),
-                C.ExceptionCheck.default(self),
-                C.Env('DeleteLocalRef', self.inner_value.jni_name) if self.inner_value.has_local_ref else [],
-                inner_transforms.cleanup,
-                C.Assign(it, it + '->next'),
+            C.Assign(length, C.Call(self.list_prefix + '_length', self.c_name), cast='jsize'),
+            C.Assign(self.jni_name, C.Env('New%sArray' % self.primitive_type_name, length)),
+            C.ExceptionCheck.default(self),
+            # short lists are gathered on the stack, and copied with a single call
+            C.Assign(elements, '%s <= (jsize) G_N_ELEMENTS(%s) ? %s : g_new(%s, %s)' % (length, buf, buf, element_type, length)),
+            C.Assign(index, '0'),
+            C.Block(
+                _start='for (%s = %s; %s; %s = %s->next) {' % (it, self.c_name, it, it, it),
+                body=[C.Assign('%s[%s++]' % (elements, index), element)],
             ),
+            C.Env('Set%sArrayRegion' % self.primitive_type_name, self.jni_name, '0', length, elements),
+            C.If('%s != %s' % (elements, buf), C.Call('g_free', elements)),
+        ], self.transfer_ownership and [
+            C.Call(self.list_prefix + '_free', self.c_name),
         ])
 
 
@@ -895,6 +1184,59 @@ class GHashTableType(ContainerMetaType(
         super(GHashTableType, self).__init__(*args, **kwargs)
         (self.inner_key, self.inner_value) = self.inner_values
 
+    def transform_to_c(self):
+        key, value = self.inner_key, self.inner_value
+        if not (is_native_container_item(key) and is_native_container_item(value)):
+            return TypeTransform([]) # FIXME: not implemented
+        entries = self.jni_name + '_entries'
+        it = self.jni_name + '_iterator'
+        entry = self.jni_name + '_entry'
+        key_transform = container_item_transform_to_c(self, key)
+        value_transform = container_item_transform_to_c(self, value)
+        if isinstance(key, StringMetaType):
+            hash_funcs = ['g_str_hash', 'g_str_equal']
+        else:
+            hash_funcs = ['g_direct_hash', 'g_direct_equal']
+        # the table frees the items that were allocated for it, whoever ends up owning it
+        free_funcs = ['(GDestroyNotify) ' + func if func else 'NULL' for func in [
+            container_item_free(key, key.transfer_ownership), container_item_free(value, value.transfer_ownership)]]
+        return TypeTransform([
+            C.Decl(self.c_type, self.c_name),
+            C.Decl('jobject', entries),
+            C.Decl('jobject', it),
+            C.Decl('jobject', entry),
+            key_transform.declarations,
+            value_transform.declarations,
+        ], [
+            C.Assign(self.c_name, 'NULL'),
+            C.If(self.jni_name, [
+                C.Assign(self.c_name, C.Call('g_hash_table_new_full', *(hash_funcs + free_funcs))),
+                C.Assign(entries, C.Env.method(self.jni_name, ('Map', 'entrySet'))),
+                C.ExceptionCheck.default(self),
+                C.Assign(it, C.Env.method(entries, ('Iterable', 'iterator'))),
+                C.ExceptionCheck.default(self),
+                C.While(C.Env.method(it, ('Iterator', 'hasNext')),
+                    C.Assign(entry, C.Env.method(it, ('Iterator', 'next'))),
+                    C.ExceptionCheck.default(self),
+                    C.Assign(key.jni_name, C.Env.method(entry, ('Map', 'Entry', 'getKey'))),
+                    C.Assign(value.jni_name, C.Env.method(entry, ('Map', 'Entry', 'getValue'))),
+                    C.ExceptionCheck.default(self),
+                    C.Env('DeleteLocalRef', entry),
+                    key_transform.conversion,
+                    value_transform.conversion,
+                    C.Env('DeleteLocalRef', key.jni_name),
+                    C.Env('DeleteLocalRef', value.jni_name),
+                    C.Call('g_hash_table_insert', self.c_name, container_item_pointer(key), container_item_pointer(value)),
+                ),
+                C.Env('DeleteLocalRef', it),
+                C.Env('DeleteLocalRef', entries),
+            ]),
+        ], not self.transfer_ownership and [
+            C.If(self.c_name, [
+                C.Call('g_hash_table_unref', self.c_name),
+            ]),
+        ])
+
     def transform_to_jni(self):
         it = self.c_name + '_it'
         inner_transforms = super(GHashTableType, self).transform_to_jni()
@@ -914,7 +1256,7 @@ class GHashTableType(ContainerMetaType(
                     inner_transforms.conversion,
                     C.Env.method(self.jni_name, ('HashMap', 'put'), self.inner_key.jni_name, self.inner_value.jni_name),
                     C.ExceptionCheck.default(self),
-                    C.Env('DeleteLocalRef', self.inner_key.jni_name) if self.inner_value.has_local_ref else [],
+                    C.Env('DeleteLocalRef', self.inner_key.jni_name) if self.inner_key.has_local_ref else [],
                     C.Env('DeleteLocalRef', self.inner_value.jni_name) if self.inner_value.has_local_ref else [],
                     inner_transforms.cleanup,
                 ),
@@ -926,6 +1268,187 @@ class GHashTableType(ContainerMetaType(
         ])
 
 
+def is_native_container_item(value):
+    # items that are stored as pointers, or as numbers in a pointer
+    if isinstance(value, PrimitiveMetaType):
+        return value.jni_type not in ['jfloat', 'jdouble']
+    return isinstance(value, (EnumMetaType, GObjectMetaType, StringMetaType))
+
+
+def native_container_item_refs(value):
+    # the functions that take and drop a reference to a borrowed item
+    if isinstance(value, GObjectMetaType):
+        return 'g_object_ref', 'g_object_unref'
+    if isinstance(value, StringMetaType):
+        return 'g_strdup', 'g_free'
+    return None, None
+
+
+def container_item_transform_to_c(container, value):
+    # converts the java object of an item to the C value that is stored in the container
+    if isinstance(value, PrimitiveMetaType):
+        return TypeTransform([
+            C.Decl('jobject', value.jni_name),
+            C.Decl(value.c_type, value.c_name),
+        ],[
+            C.Assign(value.c_name, C.Env.method(value.jni_name, (value.object_type, value.java_type + 'Value')), cast=value.c_type),
+            C.ExceptionCheck.default(container),
+        ])
+    # the cleanup of the item is left to the container
+    transform = value.transform_to_c()
+    return TypeTransform([
+        C.Decl('jobject', value.jni_name),
+        transform.declarations,
+    ], transform.conversion)
+
+
+def container_item_pointer(value):
+    # the data pointer that holds an item
+    if isinstance(value, EnumMetaType) or value.jni_type in ['jboolean', 'jbyte', 'jshort', 'jint']:
+        return 'GINT_TO_POINTER(%s)' % value.c_name
+    if isinstance(value, PrimitiveMetaType):
+        return '(gpointer) (gintptr) ' + value.c_name
+    return '(gpointer) ' + value.c_name
+
+
+def container_item_free(value, owned=False):
+    # the function that frees an item converted from java, the strings are always copies
+    if isinstance(value, StringMetaType):
+        return 'g_free'
+    if isinstance(value, GObjectMetaType) and owned:
+        return 'g_object_unref'
+    return None
+
+
+item_to_java_helpers = set()
+
+def item_to_java_helper(value):
+    # NativeContainerItemToJava for the items of a type, the container keeps ownership of the item
+    name = 'item_to_java_' + re.sub(r'\W+', '_', value.c_type.replace('*', ' ptr')).strip('_')
+    if name not in item_to_java_helpers:
+        item_to_java_helpers.add(name)
+        item = copy(value)
+        item.transfer_ownership = False
+        item.c_name = 'c_item'
+        item.jni_name = 'j_item'
+        boxed = isinstance(item, PrimitiveMetaType)
+        transform = item.transform_to_jni()
+        C.Helper.add_helper(name, C.Function(name,
+            return_type='jobject',
+            params=['JNIEnv* env', 'gpointer item'],
+            body=[
+                C.Decl(item.c_type, item.c_name),
+                transform.declarations,
+                C.Decl('jobject', 'j_item_object') if boxed else [],
+                '',
+                C.Assign(item.c_name, 'item' if item.c_type.endswith('*') else '(gintptr) item', cast=item.c_type),
+                transform.conversion,
+                transform.cleanup,
+                C.Assign('j_item_object', C.Env.static_method((item.object_type, 'valueOf'), item.jni_name)) if boxed else [],
+                C.Return('j_item_object' if boxed else item.jni_name),
+            ]
+        ))
+    return C.Helper(name).name
+
+
+# A GList, GSList or GHashTable returned as a NativeList or NativeMap, a view that converts
+# the items when they are read instead of all at once, see config.LAZY_CONTAINER_FUNCTIONS
+class NativeContainerType(GirMetaType()):
+    jni_type = 'jobject'
+    default_value = 'NULL'
+    has_local_ref = True
+
+    def __init__(self, container):
+        super(NativeContainerType, self).__init__(container.name, container.transfer_ownership, container.allow_none)
+        self.container = container
+        self.inner_values = container.inner_values
+        self.c_type = container.c_type
+        self.is_map = isinstance(container, GHashTableType)
+        self.view = 'NativeMap' if self.is_map else 'NativeList'
+        self.java_type = '%s<%s>' % (self.view, ', '.join(typ.object_type for typ in self.inner_values))
+        self.java_full_class = '%s.%s<%s>' % (config.PACKAGE_ROOT, self.view,
+            ', '.join(typ.object_full_type for typ in self.inner_values))
+        self.java_signature = 'L%s/%s;' % (config.PACKAGE_ROOT.replace('.', '/'), self.view)
+        self.doc = getattr(container, 'doc', None)
+
+    @staticmethod
+    def supports(value):
+        if not isinstance(value, (GListType, GSListType, GHashTableType)) or \
+                not all(map(is_native_container_item, value.inner_values)):
+            return False
+        # a table ref doesn't keep borrowed keys and values alive, the owner can still
+        # remove or replace them, so those tables are converted eagerly
+        if isinstance(value, GHashTableType):
+            return all(item.transfer_ownership or native_container_item_refs(item) == (None, None)
+                for item in value.inner_values)
+        return True
+
+    def transform_to_jni(self):
+        native = self.c_name + '_native'
+        index = self.jni_name + '_index'
+        if self.is_map:
+            (key, value) = self.inner_values
+            it = self.c_name + '_it'
+            # the items are owned by the table or stored by value, see supports
+            fill = [
+                C.Assign(native + '->length', '(jsize) g_hash_table_size(%s) * 2' % self.c_name),
+                C.Assign(native + '->items', C.Call('g_new', 'gpointer', native + '->length')),
+                C.Assign(native + '->key_to_java', item_to_java_helper(key)),
+                C.Assign(native + '->value_to_java', item_to_java_helper(value)),
+                C.Call('g_hash_table_iter_init', '&' + it, self.c_name),
+                C.While(C.Call('g_hash_table_iter_next', '&' + it,
+                        '&%s->items[%s]' % (native, index), '&%s->items[%s + 1]' % (native, index)),
+                    C.Assign(index, '2', op='+='),
+                ),
+                C.Assign(native + '->container', self.c_name if self.transfer_ownership
+                    else C.Call('g_hash_table_ref', self.c_name)),
+                C.Assign(native + '->free_container', 'g_hash_table_unref', cast='GDestroyNotify'),
+            ]
+            declarations = [C.Decl('GHashTableIter', it)]
+        else:
+            (value,) = self.inner_values
+            it = self.c_name + '_it'
+            ref, unref = native_container_item_refs(value)
+            item = it + '->data'
+            if ref is not None and not value.transfer_ownership:
+                item = C.Call(ref, item)
+            list_prefix = 'g_slist' if self.c_type.startswith('GSList') else 'g_list'
+            # the items are taken out of the list, so that the list itself can be freed right away
+            fill = [
+                C.Assign(native + '->length', C.Call(list_prefix + '_length', self.c_name), cast='jsize'),
+                C.Assign(native + '->items', C.Call('g_new', 'gpointer', native + '->length')),
+                C.Assign(native + '->value_to_java', item_to_java_helper(value)),
+                C.Assign(native + '->free_item', unref, cast='GDestroyNotify') if unref is not None else [],
+                C.Block(
+                    _start='for (%s = %s; %s; %s = %s->next) {' % (it, self.c_name, it, it, it),
+                    body=[C.Assign('%s->items[%s++]' % (native, index), item)],
+                ),
+                C.Call(list_prefix + '_free', self.c_name) if self.transfer_ownership else [],
+            ]
+            declarations = [C.Decl(self.c_type, it)]
+
+        conversion = [
+            C.Assign(native, C.Call('g_new0', 'NativeContainer', '1')),
+            C.Assign(index, '0'),
+            fill,
+            C.Assign(self.jni_name, C.Env.new(self.view, '(jlong) ' + native)),
+            C.If('!' + self.jni_name, C.Helper('native_container_free', native)),
+            C.ExceptionCheck.default(self),
+        ]
+        if self.is_map:
+            # a NULL list is an empty list, but a NULL table has no view
+            conversion = [
+                C.Assign(self.jni_name, 'NULL'),
+                C.If(self.c_name, conversion),
+            ]
+
+        return TypeTransform([
+            C.Decl(self.jni_type, self.jni_name),
+            C.Decl('NativeContainer*', native),
+            C.Decl('jsize', index),
+        ] + declarations, conversion)
+
+
 primitive_types = [
     CharType,
     UcharType,
@@ -35,6 +35,16 @@ class TypeRegistry:
         self.array_by_c_type = defaultdict(set)
         self.enum_aliases = {}
         self.ignored_types = []
+        self.resolved = {}
+        self.lookups = 0
+        self.lookup_hits = 0
+
+    # the lookup counters describe a single run, they aren't kept in the model cache
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['lookups'] = 0
+        state['lookup_hits'] = 0
+        return state
 
     def _register(self, typ):
         self.types.append(typ)
@@ -50,12 +60,14 @@ class TypeRegistry:
                 self.by_c_type[typ.c_type] |= set([typ])
 
     def register(self, typ):
+        self.resolved.clear()
         try:
             [self._register(t) for t in typ]
         except TypeError:
             self._register(typ)
 
     def register_enum_aliases(self, aliases):
+        self.resolved.clear()
         self.enum_aliases.update(aliases)
 
     def register_ignored_types(self, ignored):
@@ -68,6 +80,24 @@ class TypeRegistry:
         return typ in self.ignored_types
 
     def lookup(self, gir_type = None, c_type = None, is_array=False):
+        self.lookups += 1
+        key = (gir_type, c_type, is_array)
+        typ = self.resolved.get(key)
+        if typ is not None:
+            self.lookup_hits += 1
+            return typ
+        typ = self.resolved[key] = self._lookup(gir_type, c_type, is_array)
+        return typ
+
+    def lookup_stats(self):
+        return {
+            'lookups': self.lookups,
+            'hits': self.lookup_hits,
+            'misses': self.lookups - self.lookup_hits,
+            'hit_rate': float(self.lookup_hits) / self.lookups if self.lookups else 0.0,
+        }
+
+    def _lookup(self, gir_type, c_type, is_array):
         girs = None;
         cs = None;
         if is_array:
@@ -85,7 +115,7 @@ class TypeRegistry:
             return next(iter(result))
         enum_alias = self.enum_aliases.get(gir_type)
         if enum_alias is not None:
-            return self.lookup(enum_alias, c_type)
+            return self._lookup(enum_alias, c_type, False)
         if len(girs):
             return max(iter(girs))
         raise LookupError("type lookup failed (gir_type=%s, c_type=%s, is_array=%s)" % (gir_type, c_type, is_array))